@@ -0,0 +1,82 @@
+from bisect import bisect_right
+from itertools import accumulate
+from typing import List
+
+BLOCK_SIZE = 512
+
+
+class BlockList:
+    """
+    Sequence of rows kept as a list of blocks, so inserting or deleting
+    rows splices a single block instead of moving every row below.
+    A block is either a range of indices into an immutable source, for
+    rows never touched, or a list of entries.
+    """
+
+    def __init__(self, rows: int = 0):
+        self._blocks = [range(i, min(i + BLOCK_SIZE, rows)) for i in range(0, rows, BLOCK_SIZE)]
+        self._size = rows
+        self._starts = None
+
+    def __len__(self):
+        return self._size
+
+    def _block_starts(self):
+        if self._starts is None:
+            self._starts = [0]
+            self._starts.extend(accumulate(map(len, self._blocks)))
+        return self._starts
+
+    def _locate(self, y: int):
+        """
+        :return: Index of the block holding row y and of the row within it
+        """
+        if y < 0:
+            y += self._size
+        if y < 0 or y >= self._size:
+            raise IndexError('Row index out of range')
+        starts = self._block_starts()
+        b = bisect_right(starts, y) - 1
+        return b, y - starts[b]
+
+    def _list_block(self, b: int) -> list:
+        block = self._blocks[b]
+        if isinstance(block, range):
+            block = list(block)
+            self._blocks[b] = block
+        return block
+
+    def insert(self, y: int, entries: List):
+        if y < 0 or y > self._size:
+            raise IndexError('Row index out of range')
+        if not entries:
+            return
+        if y == self._size:
+            if not self._blocks:
+                self._blocks.append([])
+            b = len(self._blocks) - 1
+            i = len(self._blocks[b])
+        else:
+            b, i = self._locate(y)
+        block = self._list_block(b)
+        block[i:i] = entries
+        if len(block) > 2 * BLOCK_SIZE:
+            self._blocks[b:b + 1] = [block[j:j + BLOCK_SIZE] for j in range(0, len(block), BLOCK_SIZE)]
+        self._size += len(entries)
+        self._starts = None
+
+    def delete(self, y: int, n: int = 1):
+        if y < 0:
+            y += self._size
+        n = min(n, self._size - y)
+        while n > 0:
+            b, i = self._locate(y)
+            block = self._blocks[b]
+            k = min(n, len(block) - i)
+            if k == len(block):
+                del self._blocks[b]
+            else:
+                del self._list_block(b)[i:i + k]
+            self._size -= k
+            self._starts = None
+            n -= k
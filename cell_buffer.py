@@ -0,0 +1,126 @@
+from array import array
+
+
+class CellBuffer:
+    """
+    In-memory grid of characters and color pairs.
+    Drawing goes into the back buffer.  flush() compares it with the front
+    buffer, which mirrors what the terminal shows, and emits only the runs
+    of cells that changed.
+    """
+
+    def __init__(self, width: int, height: int):
+        self._width = width
+        self._height = height
+        self._x = 0
+        self._y = 0
+        self._chars = [[' '] * width for _ in range(height)]
+        self._colors = [array('B', bytes(width)) for _ in range(height)]
+        self._front_chars = [[' '] * width for _ in range(height)]
+        self._front_colors = [array('B', bytes(width)) for _ in range(height)]
+        self._solid_colors = {}
+        self._dirty = set()
+
+    def width(self):
+        return self._width
+
+    def height(self):
+        return self._height
+
+    def move(self, x: int, y: int) -> bool:
+        if 0 <= x < self._width and 0 <= y < self._height:
+            self._x = x
+            self._y = y
+            return True
+        return False
+
+    def position(self):
+        return min(self._x, self._width - 1), self._y
+
+    def _solid(self, color: int) -> array:
+        solid = self._solid_colors.get(color)
+        if solid is None:
+            solid = array('B', [color]) * self._width
+            self._solid_colors[color] = solid
+        return solid
+
+    def write(self, text: str, color: int):
+        """
+        Write a run of text in one color at the cursor, clipped at the
+        right edge, and advance the cursor past it
+        """
+        x = self._x
+        n = min(len(text), self._width - x)
+        if n > 0:
+            y = self._y
+            self._chars[y][x:x + n] = text if n == len(text) else text[0:n]
+            self._colors[y][x:x + n] = self._solid(color)[0:n]
+            self._dirty.add(y)
+        self._x = x + len(text)
+
+    def row_text(self, y: int) -> str:
+        return ''.join(self._chars[y])
+
+    def row_colors(self, y: int) -> array:
+        return self._colors[y]
+
+    def scroll(self, x: int, y: int, width: int, height: int, dy: int):
+        """
+        Move the cells of a rectangle up by dy rows, or down if dy is
+        negative, along with what the terminal shows there, as a terminal
+        scroll region does.  The rows scrolled in are unknown, so the next
+        flush repaints them.
+        """
+        x1 = min(x + width, self._width)
+        y1 = min(y + height, self._height)
+        if abs(dy) >= y1 - y:
+            return
+        rows = range(y, y1 - dy) if dy > 0 else range(y1 - 1, y - dy - 1, -1)
+        for grid in (self._chars, self._colors, self._front_chars, self._front_colors):
+            for row in rows:
+                grid[row][x:x1] = grid[row + dy][x:x1]
+        exposed = range(y1 - dy, y1) if dy > 0 else range(y, y - dy)
+        for row in exposed:
+            self._front_chars[row][x:x1] = [''] * (x1 - x)
+        self._dirty.update(range(y, y1))
+
+    def invalidate(self):
+        """
+        Forget what the terminal shows, so the next flush repaints every cell
+        """
+        for y in range(self._height):
+            self._front_chars[y] = [''] * self._width
+        self._dirty.update(range(self._height))
+
+    def flush(self, emit):
+        """
+        Emit the changed cells as runs of the same color
+        :param emit: Called with x, y, text and color for every run
+        :return: Number of runs emitted
+        """
+        runs = 0
+        for y in sorted(self._dirty):
+            chars, colors = self._chars[y], self._colors[y]
+            front_chars, front_colors = self._front_chars[y], self._front_colors[y]
+            if chars == front_chars and colors == front_colors:
+                continue
+            x0 = 0
+            while chars[x0] == front_chars[x0] and colors[x0] == front_colors[x0]:
+                x0 += 1
+            x1 = self._width
+            while chars[x1 - 1] == front_chars[x1 - 1] and colors[x1 - 1] == front_colors[x1 - 1]:
+                x1 -= 1
+            start = x0
+            color = colors[x0]
+            for x in range(x0 + 1, x1):
+                if colors[x] != color:
+                    emit(start, y, ''.join(chars[start:x]), color)
+                    runs += 1
+                    start = x
+                    color = colors[x]
+            emit(start, y, ''.join(chars[start:x1]), color)
+            runs += 1
+            front_chars[x0:x1] = chars[x0:x1]
+            front_colors[x0:x1] = colors[x0:x1]
+        self._dirty.clear()
+        return runs
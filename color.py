@@ -14,6 +14,9 @@ type_colors = {
     "type": 28,
     "typeParameter": 29,
     "variable": 30,
+    "keyword": 31,
+    "string": 32,
+    "number": 33,
 }
 
 color_names = {}
@@ -31,6 +34,7 @@ class Color:
     FOCUS = 3
     BORDER = 4
     BORDER_HIGHLIGHT = 5
+    SEARCH = 6
     ERROR = 7
 
 
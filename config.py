@@ -52,6 +52,7 @@ def generate_default_keymap(path: str):
         ctrl('R'): 'macro_record',
         ctrl('P'): 'macro_play',
         ctrl('Z'): 'undo',
+        ctrl('Y'): 'redo',
 
         '\t': 'tab',
         '\n': 'enter'
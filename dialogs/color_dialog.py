@@ -19,7 +19,7 @@ class ColorDialog(FormDialog):
         self.sample.set_text('Sample')
         self.sample.disable_border()
         self.add_widget(self.sample)
-        for i in range(1, 32):
+        for i in range(1, 34):
             name = color_name(i)
             self._pair_list.add_item(name)
         self._pair_list.listen('selection_changed', self._set_current_pair)
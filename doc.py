@@ -1,59 +1,309 @@
 import os
-from typing import List
+import hashlib
+import functools
+import locale
+import stat
+import tempfile
+import threading
 from visual_line import VisualLine
+from line_store import LineStore, TextSource, MappedSource
 from geom import Point
 from cursor import Cursor
-from collections import defaultdict
+from semantic_tokens import SemanticTokens, SemanticHighlights
+from lexer import IncrementalLexer, grammar_for
+from undo import UndoLog, Journal, InsertText, DeleteText, SplitLine, JoinLines, InsertBlock, DeleteRange, DeleteLine, \
+    InsertLine
+import config
 import logger
 
 
-class Compound:
-    def __init__(self, start: bool, cursor: Cursor = None):
-        self.start = start
-        self.cursor = Cursor(cursor.x, cursor.y)
+SAVE_CHUNK_SIZE = 1 << 20
+EDIT_LOG_LIMIT = 100000
+EMPTY_DIGEST = hashlib.sha1().digest()
+
+
+def _new_file_mode() -> int:
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0o666 & ~umask
+
+
+def write_file_atomic(path: str, texts, encoding: str) -> bytes:
+    """
+    Write lines to a temporary file next to path in large chunks, sync it
+    and rename it over path, so the file is never left half written
+    :param texts: Iterable of the line texts
+    :return: SHA-1 digest of the written content
+    """
+    target = os.path.realpath(path)
+    try:
+        mode = stat.S_IMODE(os.stat(target).st_mode)
+    except FileNotFoundError:
+        mode = _new_file_mode()
+    directory, name = os.path.split(target)
+    fd, temp_path = tempfile.mkstemp(prefix=f'.{name}.', suffix='.tmp', dir=directory)
+    digest = hashlib.sha1()
+    try:
+        with open(fd, 'wb') as f:
+            separator = ''
+            chunk = []
+            size = 0
+            for text in texts:
+                chunk.append(text)
+                size += len(text) + 1
+                if size >= SAVE_CHUNK_SIZE:
+                    data = (separator + '\n'.join(chunk)).encode(encoding)
+                    f.write(data)
+                    digest.update(data)
+                    separator = '\n'
+                    chunk = []
+                    size = 0
+            if chunk:
+                data = (separator + '\n'.join(chunk)).encode(encoding)
+                f.write(data)
+                digest.update(data)
+            f.flush()
+            os.fchmod(f.fileno(), mode)
+            os.fsync(f.fileno())
+        os.replace(temp_path, target)
+    except BaseException:
+        try:
+            os.unlink(temp_path)
+        except OSError:
+            pass
+        raise
+    return digest.digest()
 
 
 class Document:
     def __init__(self, filename: str, view):
-        self._lines: List[VisualLine] = [VisualLine('')]
+        self._lines = LineStore()
         self._last_coloring_id: str = ''
+        self._semantic_tokens = None
         self._modified = False
-        self._undo_stack = []
+        self._changes = 0
+        self._save_generation = 0
+        self._base_digest = EMPTY_DIGEST
+        # Edits since the last save, kept only once recovery snapshots ask for them
+        self._edit_log = None
+        self._edits_lost = False
+        self._save_thread = None
+        self._save_result = None
+        self._undo_log = self._create_undo_log()
         self._undoing = False
+        self._notify_depth = 0
+        self._pending_row = None
         self._path = ''
         self._view = view
         self._modification_callbacks = []
-        self._semantic_highlights = defaultdict(list)
+        self._edit_callbacks = []
+        self._semantic_highlights = SemanticHighlights()
+        self._semantic_coverage = (-1, 0, 0)
+        self._highlights_version = 0
+        self._lexer = None
         if filename:
             if not self.load(filename):
                 raise IOError()
 
-    def clear_semantic_highlight(self, row: int):
-        if row < 0:
-            self._semantic_highlights = defaultdict(list)
+    def set_semantic_highlights(self, highlights: SemanticTokens, top: int = 0, bottom: int = -1):
+        """
+        :param top: First row the highlights cover
+        :param bottom: Row after the last one they cover, or -1 for a coloring of the whole document
+        """
+        self._highlights_version += 1
+        if bottom < 0:
+            self._semantic_highlights = SemanticHighlights(highlights, self.rows_count())
+            self._semantic_coverage = (self._changes, 0, -1)
         else:
-            self._semantic_highlights[row] = []
+            if len(self._semantic_highlights) != self.rows_count():
+                self._semantic_highlights = SemanticHighlights(SemanticTokens(), self.rows_count())
+            self._semantic_highlights.replace(top, bottom, highlights)
+            changes, covered_top, covered_bottom = self._semantic_coverage
+            if changes == self._changes and (covered_bottom < 0 or top <= covered_bottom and covered_top <= bottom):
+                if covered_bottom >= 0:
+                    self._semantic_coverage = (changes, min(top, covered_top), max(bottom, covered_bottom))
+            else:
+                self._semantic_coverage = (self._changes, top, bottom)
+
+    def semantic_highlights_cover(self, top: int, bottom: int) -> bool:
+        """
+        :return: True if the semantic highlights of rows top to bottom are up to date
+        """
+        changes, covered_top, covered_bottom = self._semantic_coverage
+        if changes != self._changes:
+            return False
+        return covered_bottom < 0 or covered_top <= top and bottom <= covered_bottom
 
-    def add_semantic_highlight(self, y: int, col: int, length: int, token_type: str):
-        # logger.logwrite(f'Highlight: y={y} col={col} length={length} type={token_type}')
-        self._semantic_highlights[y].append((col, length, token_type))
+    def has_full_semantic_highlights(self) -> bool:
+        return self._semantic_coverage[0] == self._changes and self._semantic_coverage[2] < 0
 
     def get_semantic_highlights(self):
+        if self._lexer is not None:
+            return self._lexer
         return self._semantic_highlights
 
+    def highlights_version(self, row: int):
+        """
+        :return: Value that, along with the version of the row's line, changes
+        whenever the highlights of the row change
+        """
+        if self._lexer is not None:
+            return self._highlights_version, self._lexer.version(row)
+        return self._highlights_version
+
+    def set_local_highlighting(self, enabled: bool):
+        """
+        Highlight with the built-in lexer for the file type, if there is one
+        """
+        self._highlights_version += 1
+        grammar = grammar_for(self._path) if enabled else None
+        if grammar is None:
+            self._lexer = None
+        else:
+            self._lexer = IncrementalLexer(grammar, lambda y: self._lines.text(y), self.rows_count())
+
+    def lex_ahead(self, rows: int) -> bool:
+        """
+        Lex up to rows more rows with the built-in lexer
+        :return: True if there are rows left to lex
+        """
+        return self._lexer is not None and self._lexer.lex_ahead(rows)
+
+    def take_changed_highlights(self):
+        """
+        :return: Rows whose local highlights changed since the last call other than by an edit of the row
+        """
+        return self._lexer.take_changed() if self._lexer is not None else []
+
     def set_coloring_id(self, coloring_id: str):
         self._last_coloring_id = coloring_id
 
     def get_last_coloring_id(self):
         return self._last_coloring_id
 
+    def set_semantic_tokens(self, coloring_id: str, data):
+        """
+        Keep the token array of the last coloring result, so the next
+        request can ask only for the changes since
+        """
+        self._last_coloring_id = coloring_id if data is not None else ''
+        self._semantic_tokens = data
+
+    def get_semantic_tokens(self):
+        return self._semantic_tokens
+
+    @staticmethod
+    def _create_undo_log():
+        return UndoLog(config.get_int('undo_budget', 16 << 20), config.get_int('undo_journal_limit', 64 << 20))
+
+    def _open_journal(self, reattach: bool):
+        """
+        Keep the undo history of the document's file under ~/.termed/undo.
+        When reattaching, history saved along with the current content of
+        the file becomes undoable again; it is read only when undone.
+        """
+        if not self._path or not config.get_bool('undo_journal', True):
+            return
+        try:
+            directory = os.path.join(config.cfg_dir, 'undo')
+            os.makedirs(directory, 0o700, True)
+            name = hashlib.sha1(self._path.encode('utf-8', 'surrogateescape')).hexdigest()
+            journal = Journal(os.path.join(directory, name))
+            if reattach and journal.size() > 0:
+                journal.compact(config.get_int('undo_journal_limit', 64 << 20))
+                journal.reattach(self.base_digest())
+            else:
+                journal.truncate(0)
+        except OSError as e:
+            logger.logwrite(f'Undo journal unavailable for {self._path}: {e}')
+            return
+        self._undo_log.attach(journal)
+
+    def _record(self, edit):
+        if self._edit_log is not None and not self._edits_lost:
+            if len(self._edit_log) < EDIT_LOG_LIMIT:
+                self._edit_log.append(edit.copy())
+            else:
+                self._edit_log = []
+                self._edits_lost = True
+        if not self._undoing:
+            self._undo_log.record(edit, self._view.get_cursor())
+        self._semantic_highlights.apply(edit)
+        if self._lexer is not None:
+            self._lexer.apply(edit)
+        for cb in self._edit_callbacks:
+            cb(self, edit)
+
+    def track_edits(self):
+        """
+        Start keeping the edits for take_edits.
+        Unsaved edits made before are reported as lost.
+        """
+        if self._edit_log is None:
+            self._edit_log = []
+            self._edits_lost = self._modified
+
+    def take_edits(self):
+        """
+        :return: Edits made since the last save or the last call, or None if
+        there were too many to keep track of
+        """
+        self.track_edits()
+        edits = None if self._edits_lost else self._edit_log
+        self._edit_log = []
+        self._edits_lost = False
+        return edits
+
+    def _reset_edit_log(self):
+        if self._edit_log is not None:
+            self._edit_log = []
+            self._edits_lost = False
+
+    def save_generation(self) -> int:
+        return self._save_generation
+
+    def base_digest(self):
+        """
+        :return: Function computing the SHA-1 of the file content that the edits
+        since the last save apply to.  It may read the whole file, and is safe
+        to call on another thread.
+        """
+        digest = self._base_digest
+        if digest is None:
+            return self._lines.source_digest
+        return lambda: digest
+
+    def snapshot(self):
+        """
+        :return: Generator of the line texts as they are now, safe to consume on another thread
+        """
+        return self._lines.snapshot()
+
     def add_modification_callback(self, cb):
         if cb not in self._modification_callbacks:
             self._modification_callbacks.append(cb)
 
+    def add_edit_callback(self, cb):
+        """
+        :param cb: Called with the document and the edit record for every change made
+        """
+        if cb not in self._edit_callbacks:
+            self._edit_callbacks.append(cb)
+
+    def _set_lines(self, lines: LineStore):
+        # A background save may still be reading the lines being replaced
+        self.wait_for_save()
+        self._lines.close()
+        self._lines = lines
+
     def clear(self):
-        self._lines = [VisualLine('')]
-        self._undo_stack = []
+        self._set_lines(LineStore())
+        if self._lexer is not None:
+            self.set_local_highlighting(True)
+        self._base_digest = EMPTY_DIGEST
+        self._reset_edit_log()
+        self._undo_log.close()
+        self._undo_log = self._create_undo_log()
         self._undoing = False
         self._modified = False
 
@@ -69,35 +319,122 @@ class Document:
     def load(self, filename):
         try:
             path = os.path.abspath(filename)
-            lines = [line.rstrip() for line in open(path).readlines()]
-            self._lines = [VisualLine(s.rstrip()) for s in lines]
+            size = os.path.getsize(path)
+            encoding = locale.getpreferredencoding(False)
+            if size > 0 and size >= config.get_int('mmap_threshold', 16 << 20):
+                self._set_lines(LineStore(MappedSource(path, encoding)))
+                self._base_digest = None
+            else:
+                with open(path, 'rb') as f:
+                    data = f.read()
+                self._set_lines(LineStore(TextSource(data.decode(encoding, errors='replace'))))
+                self._base_digest = hashlib.sha1(data).digest()
+            self._reset_edit_log()
             self._path = path
         except OSError:
             return False
-        except UnicodeDecodeError:
-            return False
+        self._open_journal(True)
         return True
 
-    def save(self, path=''):
+    def save(self, path='', background=False):
+        """
+        Write the document to its file
+        :param path: New path to save to
+        :param background: Write on a separate thread, from a snapshot of the lines.
+        The document stays editable; it is marked as saved when the write completes
+        and nothing was changed in the meantime.
+        """
+        renamed = path and path != self._path
         if path:
             self._path = path
         if self._path and len(self._lines) > 0 and self._modified:
-            with open(self._path, 'w') as f:
-                f.write(self._lines[0].get_logical_text())
-                for line in self._lines[1:]:
-                    f.write('\n')
-                    text = line.get_logical_text()
-                    if text:
-                        f.write(text)
-                self.set_modified(False)
+            self.wait_for_save()
+            if renamed:
+                self._open_journal(False)
+            texts = self._lines.snapshot()
+            changes = self._changes
+            encoding = locale.getpreferredencoding(False)
+            path = self._path
+            app = config.get_app()
+            if background and app is not None:
+                def run():
+                    try:
+                        self._save_result = changes, write_file_atomic(path, texts, encoding), None
+                    except Exception as e:
+                        self._save_result = changes, None, e
+                    app.post(functools.partial(self._finish_save, thread))
+
+                thread = threading.Thread(target=run)
+                self._save_thread = thread
+                thread.start()
+            else:
+                self._save_result = changes, write_file_atomic(path, texts, encoding), None
+                self._finish_save()
+
+    def is_saving(self) -> bool:
+        return self._save_thread is not None
+
+    def wait_for_save(self):
+        """
+        Block until a background save completes
+        """
+        if self._save_thread is not None:
+            self._save_thread.join()
+            self._finish_save(self._save_thread)
+
+    def _finish_save(self, thread=None):
+        """
+        :param thread: Thread that wrote the file, None for a save on this thread.
+        A completion posted by a thread that wait_for_save already finished is ignored.
+        """
+        if thread is not self._save_thread:
+            return
+        self._save_thread = None
+        if self._save_result is None:
+            return
+        changes, digest, error = self._save_result
+        self._save_result = None
+        if error is not None:
+            logger.logwrite(f'Failed to save {self._path}: {error}')
+        elif changes == self._changes:
+            self.set_modified(False)
+            self._undo_log.checkpoint(digest)
+            self._base_digest = digest
+            self._reset_edit_log()
+            self._save_generation += 1
 
     def mark_modified(self, y: int):
+        if self._notify_depth > 0:
+            if self._pending_row is None:
+                self._pending_row = y
+            elif self._pending_row != y:
+                self._pending_row = -1
+            return
         for cb in self._modification_callbacks:
             cb(self, y)
 
+    def _hold_notifications(self):
+        self._notify_depth += 1
+
+    def _release_notifications(self):
+        """
+        Send a single notification for everything modified since the
+        outermost hold: the row if only one row changed, otherwise -1
+        """
+        self._notify_depth = max(0, self._notify_depth - 1)
+        if self._notify_depth == 0 and self._pending_row is not None:
+            row = self._pending_row
+            self._pending_row = None
+            self.mark_modified(row)
+
     def set_modified(self, state: bool):
+        if state:
+            self._changes += 1
         self._modified = state
 
+    def change_count(self) -> int:
+        return self._changes
+
     def is_modified(self) -> bool:
         return self._modified
 
@@ -108,52 +445,92 @@ class Document:
         return len(self._lines)
 
     def get_row(self, y: int) -> VisualLine:
-        return self._lines[y]
+        return self._lines.get(y)
+
+    def _edit_row(self, y: int) -> VisualLine:
+        return self._lines.materialize(y)
 
     def get_text(self, rows=False):
-        lines = [line.get_logical_text() for line in self._lines]
+        lines = list(self._lines.texts())
         if rows:
             return lines
         return '\n'.join(lines)
 
     def insert_text(self, cursor: Cursor, text: str):
         self.set_modified(True)
-        line = self.get_row(cursor.y)
+        line = self._edit_row(cursor.y)
         n = line.get_logical_len()
         x = min(cursor.x, n)
-        if not self._undoing:
-            self._undo_stack.append([self._view.get_cursor(), self.delete_block, cursor.y, x, x + len(text)])
+        self._record(InsertText(cursor.y, x, text))
         line.insert(x, text)
         self.mark_modified(cursor.y)
 
+    def insert_block(self, cursor: Cursor, text: str) -> Cursor:
+        """
+        Insert text that may span several lines, splicing all new
+        lines into the store in one operation
+        :return: Position right after the inserted text
+        """
+        if '\n' not in text:
+            x = min(cursor.x, self.get_row(cursor.y).get_logical_len())
+            self.insert_text(cursor, text)
+            return Cursor(x + len(text), cursor.y)
+        self.set_modified(True)
+        lines = text.split('\n')
+        line = self._edit_row(cursor.y)
+        x = min(cursor.x, line.get_logical_len())
+        tail = line.split(x)
+        line.append(lines[0])
+        new_lines = [VisualLine(s) for s in lines[1:]]
+        new_lines[-1].extend(tail)
+        self._lines.insert(cursor.y + 1, new_lines)
+        end = Cursor(len(lines[-1]), cursor.y + len(new_lines))
+        self._record(InsertBlock(cursor.y, x, end.y, end.x, text))
+        self.mark_modified(-1)
+        return end
+
+    def delete_range(self, y0: int, x0: int, y1: int, x1: int):
+        """
+        Delete the text from (x0,y0) up to (x1,y1) in one operation
+        """
+        if y0 == y1:
+            self.delete_block(y0, x0, x1)
+            return
+        self.set_modified(True)
+        first = self._edit_row(y0)
+        last_text = self._lines.text(y1)
+        removed = [first.get_logical_text()[x0:]]
+        removed.extend(self._lines.text(y) for y in range(y0 + 1, y1))
+        removed.append(last_text[0:x1])
+        self._record(DeleteRange(y0, x0, y1, x1, '\n'.join(removed)))
+        first.erase(x0, first.get_logical_len() - x0)
+        first.append(last_text[x1:])
+        self._lines.delete(y0 + 1, y1 - y0)
+        self.mark_modified(-1)
+
     def split_line(self, cursor: Cursor):
         self.set_modified(True)
-        line = self.get_row(cursor.y)
+        line = self._edit_row(cursor.y)
         line = line.split(cursor.x)
-        self.insert(line, cursor.y + 1)
+        self._lines.insert(cursor.y + 1, [line])
         self.mark_modified(-1)
-        if not self._undoing:
-            self._undo_stack.append([self._view.get_cursor(), self.join_next_row, cursor.y])
+        self._record(SplitLine(cursor.y, cursor.x))
 
     def join_next_row(self, row_index: int):
         if 0 <= row_index < (self.rows_count() - 1):
-            row = self.get_row(row_index)
+            row = self._edit_row(row_index)
             next_row = self.get_row(row_index + 1)
-            del self._lines[row_index + 1]
-            if not self._undoing:
-                self._undo_stack.append(
-                    [self._view.get_cursor(), self.split_line, Cursor(row.get_logical_len(), row_index)])
+            self._lines.delete(row_index + 1)
+            self._record(JoinLines(row_index, row.get_logical_len()))
             row.extend(next_row)
             self.set_modified(True)
             self.mark_modified(-1)
 
     def delete(self, cursor: Cursor):
-        line = self.get_row(cursor.y)
+        line = self._edit_row(cursor.y)
         if cursor.x < line.get_logical_len():
             self.set_modified(True)
-            if not self._undoing:
-                self._undo_stack.append(
-                    [self._view.get_cursor(), self.insert_text, cursor, line.get_logical_text()[cursor.x]])
+            self._record(DeleteText(cursor.y, cursor.x, line.get_logical_text()[cursor.x]))
             line.erase(cursor.x)
             self.mark_modified(cursor.y)
         elif cursor.y < (self.size() - 1):
@@ -176,29 +553,27 @@ class Document:
     def delete_line(self, index: int):
         if 0 <= index < len(self._lines):
             self.set_modified(True)
-            if not self._undoing:
-                self._undo_stack.append([self._view.get_cursor(), self.insert, self._lines[index], index])
-            del self._lines[index]
+            self._record(DeleteLine(index, self._lines.text(index)))
+            self._lines.delete(index)
             self.mark_modified(-1)
 
     def delete_block(self, y: int, x0: int, x1: int):
         self.set_modified(True)
-        line = self.get_row(y)
+        line = self._edit_row(y)
         if x1 < 0:
             raise RuntimeError('Invalid x1 value')
         n = x1 - x0
         x0, n = line.clip_coords(x0, n)
         if n > 0:
-            if not self._undoing:
-                self._undo_stack.append(
-                    [self._view.get_cursor(), self.insert_text, Cursor(x0, y), line.get_logical_text()[x0:(x0 + n)]])
+            self._record(DeleteText(y, x0, line.get_logical_text()[x0:(x0 + n)]))
             line.erase(x0, n)
             self.mark_modified(y)
 
     def insert(self, line: VisualLine, at: int):
         self.set_modified(True)
-        self._lines.insert(at, line)
+        self._lines.insert(at, [line])
         self.mark_modified(-1)
+        self._record(InsertLine(at, line.get_logical_text()))
 
     def set_cursor(self, cursor: Cursor):
         if cursor.y < 0:
@@ -214,7 +589,7 @@ class Document:
         return Point(x, cursor.y)
 
     def replace_text(self, cursor: Cursor, text: str, replace_count: int = -1):
-        line = self._lines[cursor.y]
+        line = self.get_row(cursor.y)
         if replace_count < 0:
             replace_count = len(text)
         replace_count = min(line.get_logical_len() - cursor.x, replace_count)
@@ -225,39 +600,31 @@ class Document:
         self.set_modified(True)
 
     def start_compound(self):
+        self._hold_notifications()
         if not self._undoing:
-            self._undo_stack.append(Compound(True, self._view.get_cursor()))
+            self._undo_log.begin(self._view.get_cursor())
 
     def stop_compound(self):
         if not self._undoing:
-            if len(self._undo_stack) == 0:
-                return
-            last = self._undo_stack[-1]
-            if isinstance(last, Compound) and last.start:
-                del self._undo_stack[-1]
-            else:
-                self._undo_stack.append(Compound(False, self._view.get_cursor()))
+            self._undo_log.end()
+        self._release_notifications()
 
-    def undo(self):
-        depth = 0
-        if len(self._undo_stack) > 0:
-            self.set_modified(True)
+    def _replay(self, replay):
         self._undoing = True
-        res = Point(0, 0)
-        while len(self._undo_stack) > 0:
-            cmd = self._undo_stack[-1]
-            del self._undo_stack[-1]
-            if isinstance(cmd, Compound):
-                depth += 1 if cmd.start else -1
-                if cmd.start and depth == 0:
-                    self._view.set_cursor(cmd.cursor)
-                    break
-            else:
-                cursor = cmd[0]
-                del cmd[0]
-                f = cmd[0]
-                f(*cmd[1:])
-                if self._view and depth == 0:
-                    self._view.set_cursor(cursor)
-        self._undoing = False
-        return res
+        self._hold_notifications()
+        try:
+            cursor = replay(self)
+        finally:
+            self._undoing = False
+            self._release_notifications()
+        if cursor is not None:
+            self.set_modified(True)
+            if self._view:
+                self._view.set_cursor(cursor)
+        return cursor
+
+    def undo(self):
+        return self._replay(self._undo_log.undo)
+
+    def redo(self):
+        return self._replay(self._undo_log.redo)
@@ -0,0 +1,102 @@
+import heapq
+import itertools
+import os
+import selectors
+import time
+from collections import deque
+
+
+class Timer:
+    def __init__(self, deadline: float, callback, args):
+        self.deadline = deadline
+        self._callback = callback
+        self._args = args
+        self._cancelled = False
+
+    def cancel(self):
+        self._cancelled = True
+
+    def is_cancelled(self) -> bool:
+        return self._cancelled
+
+    def fire(self):
+        if not self._cancelled:
+            self._cancelled = True
+            self._callback(*self._args)
+
+
+class EventLoop:
+    """
+    Waits on file descriptors, timers and callbacks posted from other
+    threads, and sleeps when there is nothing to do.
+    """
+
+    def __init__(self):
+        self._selector = selectors.DefaultSelector()
+        self._timers = []
+        self._sequence = itertools.count()
+        self._posted = deque()
+        self._wake_read, self._wake_write = os.pipe()
+        os.set_blocking(self._wake_read, False)
+        os.set_blocking(self._wake_write, False)
+        self._selector.register(self._wake_read, selectors.EVENT_READ, self._drain_wakeup)
+
+    def close(self):
+        self._selector.close()
+        os.close(self._wake_read)
+        os.close(self._wake_write)
+
+    def add_reader(self, fd: int, callback):
+        self._selector.register(fd, selectors.EVENT_READ, callback)
+
+    def remove_reader(self, fd: int):
+        try:
+            self._selector.unregister(fd)
+        except (KeyError, ValueError):
+            pass
+
+    def call_later(self, delay: float, callback, *args) -> Timer:
+        timer = Timer(time.monotonic() + delay, callback, args)
+        heapq.heappush(self._timers, (timer.deadline, next(self._sequence), timer))
+        return timer
+
+    def post(self, callback, *args):
+        """
+        Run callback on the loop's thread.  Safe to call from any thread.
+        """
+        self._posted.append((callback, args))
+        try:
+            os.write(self._wake_write, b'\0')
+        except BlockingIOError:
+            pass
+
+    def _drain_wakeup(self):
+        try:
+            while os.read(self._wake_read, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def _timeout(self):
+        while self._timers and self._timers[0][2].is_cancelled():
+            heapq.heappop(self._timers)
+        if self._posted:
+            return 0
+        if not self._timers:
+            return None
+        return max(0.0, self._timers[0][0] - time.monotonic())
+
+    def run_once(self):
+        """
+        Block until something happens, then dispatch it:
+        ready descriptors, posted callbacks and timers that are due
+        """
+        for key, _ in self._selector.select(self._timeout()):
+            key.data()
+        while self._posted:
+            callback, args = self._posted.popleft()
+            callback(*args)
+        now = time.monotonic()
+        while self._timers and self._timers[0][0] <= now:
+            _, _, timer = heapq.heappop(self._timers)
+            timer.fire()
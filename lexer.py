@@ -0,0 +1,311 @@
+import os
+import re
+from itertools import count
+from typing import Dict, List
+from semantic_tokens import extend_item_spans
+from undo import InsertText, DeleteText, SplitLine, JoinLines, InsertBlock, DeleteRange, DeleteLine, InsertLine
+
+LEX_AHEAD = 1000
+# Global, so that a row version also tells lexers apart
+_versions = count(1)
+
+
+class Grammar:
+    """
+    Regular expression state machine.
+    Each state has rules (pattern, token type, next state name or None to
+    stay) tried at every position, and a token type for the text between
+    matches.  Lines start in the state the previous line ended in, so
+    constructs like block comments and long strings span lines.
+    """
+
+    def __init__(self, states: Dict[str, tuple]):
+        """
+        :param states: Name to (default token type, list of rules).  The first state is the initial one.
+        """
+        names = list(states.keys())
+        self._defaults = []
+        self._patterns = []
+        self._rules = []
+        for name in names:
+            default_type, rules = states[name]
+            self._defaults.append(default_type)
+            self._patterns.append(re.compile('|'.join(f'(?P<r{i}>{rule[0]})' for i, rule in enumerate(rules))))
+            self._rules.append([(token_type, names.index(state) if state else -1) for _, token_type, state in rules])
+
+    def lex(self, text: str, state: int):
+        """
+        :return: List of (column, length, token type) and the state at the end of the line
+        """
+        tokens = []
+        x = 0
+        n = len(text)
+
+        def add(col: int, length: int, token_type: str):
+            if tokens and tokens[-1][0] + tokens[-1][1] == col and tokens[-1][2] == token_type:
+                tokens[-1] = (tokens[-1][0], tokens[-1][1] + length, token_type)
+            else:
+                tokens.append((col, length, token_type))
+
+        while x < n:
+            m = self._patterns[state].search(text, x)
+            start = m.start() if m else n
+            default_type = self._defaults[state]
+            if start > x and default_type:
+                add(x, start - x, default_type)
+            if m is None:
+                break
+            token_type, next_state = self._rules[state][int(m.lastgroup[1:])]
+            end = m.end()
+            if token_type and end > start:
+                add(start, end - start, token_type)
+            if next_state >= 0:
+                state = next_state
+            x = end if end > start else end + 1
+        return tokens, state
+
+
+def _words(words: str) -> str:
+    return r'\b(?:' + '|'.join(words.split()) + r')\b'
+
+
+_NUMBER = r'\b(?:0[xX][0-9a-fA-F_]+|\d[\d_]*\.?\d*(?:[eE][+-]?\d+)?)[jJlLuUfF]*\b'
+_C_COMMENTS = [(r'//.*', 'comment', None), (r'/\*', 'comment', 'block_comment')]
+_C_STRINGS = [(r'"(?:[^"\\]|\\.)*"?', 'string', None), (r"'(?:[^'\\]|\\.)*'?", 'string', None)]
+_BLOCK_COMMENT = ('comment', [(r'\*/', 'comment', 'code')])
+
+PYTHON = Grammar({
+    'code': (None, [
+        (r'#.*', 'comment', None),
+        (r'[rRbBuUfF]{0,2}"""', 'string', 'long_double'),
+        (r"[rRbBuUfF]{0,2}'''", 'string', 'long_single'),
+        (r'[rRbBuUfF]{0,2}"(?:[^"\\]|\\.)*"?', 'string', None),
+        (r"[rRbBuUfF]{0,2}'(?:[^'\\]|\\.)*'?", 'string', None),
+        (r'@[\w.]+', 'macro', None),
+        (_words('False None True and as assert async await break class continue def del elif else except '
+                'finally for from global if import in is lambda nonlocal not or pass raise return try while '
+                'with yield'), 'keyword', None),
+        (_words('self cls'), 'parameter', None),
+        (r'\w+(?=\s*\()', 'function', None),
+        (_NUMBER, 'number', None),
+    ]),
+    'long_double': ('string', [(r'\\.', 'string', None), (r'"""', 'string', 'code')]),
+    'long_single': ('string', [(r'\\.', 'string', None), (r"'''", 'string', 'code')]),
+})
+
+C = Grammar({
+    'code': (None, _C_COMMENTS + _C_STRINGS + [
+        (r'^\s*#\s*\w+', 'macro', None),
+        (_words('alignas alignof auto bool break case catch char class const constexpr const_cast continue '
+                'decltype default delete do double dynamic_cast else enum explicit export extern false float for '
+                'friend goto if inline int long mutable namespace new noexcept nullptr operator override private '
+                'protected public register reinterpret_cast return short signed sizeof static static_assert '
+                'static_cast struct switch template this throw true try typedef typeid typename union unsigned '
+                'using virtual void volatile while'), 'keyword', None),
+        (r'\w+(?=\s*\()', 'function', None),
+        (_NUMBER, 'number', None),
+    ]),
+    'block_comment': _BLOCK_COMMENT,
+})
+
+JAVASCRIPT = Grammar({
+    'code': (None, _C_COMMENTS + _C_STRINGS + [
+        (r'`', 'string', 'template'),
+        (_words('async await break case catch class const continue debugger default delete do else export '
+                'extends false finally for from function if import in instanceof interface let new null of '
+                'return static super switch this throw true try type typeof undefined var void while with '
+                'yield'), 'keyword', None),
+        (r'\w+(?=\s*\()', 'function', None),
+        (_NUMBER, 'number', None),
+    ]),
+    'block_comment': _BLOCK_COMMENT,
+    'template': ('string', [(r'\\.', 'string', None), (r'`', 'string', 'code')]),
+})
+
+SHELL = Grammar({
+    'code': (None, [
+        (r'(?:^|(?<=\s))#.*', 'comment', None),
+        (r'"(?:[^"\\]|\\.)*"?', 'string', None),
+        (r"'[^']*'?", 'string', None),
+        (r'\$\{?\w+\}?', 'variable', None),
+        (_words('case do done elif else esac export fi for function if in local return select then until '
+                'while'), 'keyword', None),
+        (_NUMBER, 'number', None),
+    ]),
+})
+
+GRAMMARS = {
+    '.py': PYTHON, '.pyw': PYTHON,
+    '.c': C, '.h': C, '.cc': C, '.cpp': C, '.cxx': C, '.hh': C, '.hpp': C, '.hxx': C, '.java': C,
+    '.js': JAVASCRIPT, '.jsx': JAVASCRIPT, '.mjs': JAVASCRIPT, '.ts': JAVASCRIPT, '.tsx': JAVASCRIPT,
+    '.sh': SHELL, '.bash': SHELL,
+}
+
+
+def grammar_for(path: str):
+    return GRAMMARS.get(os.path.splitext(path)[1].lower())
+
+
+class IncrementalLexer:
+    """
+    Local syntax highlighting, served like semantic highlights.
+    Every row caches the state it was lexed from, the state it ended in
+    and its tokens.  Rows before the frontier are known to be right, and
+    rows from there up to the watermark were lexed one after the other.
+    An edit pulls the frontier back to the edited row, and moving it
+    forward again re-lexes only rows that were edited or start in a
+    different state than before, so once the states converge the frontier
+    jumps to the watermark.
+    Rows far beyond the frontier are lexed from a guessed state until the
+    frontier reaches them.
+    """
+
+    def __init__(self, grammar: Grammar, text, rows: int):
+        """
+        :param text: Function returning the text of a row
+        """
+        self._grammar = grammar
+        self._text = text
+        self._starts: List = [None] * rows
+        self._ends: List[int] = [0] * rows
+        self._tokens: List = [None] * rows
+        self._versions: List[int] = [0] * rows
+        self._frontier = 0
+        self._lexed = 0
+        self._changed = set()
+
+    def __len__(self):
+        return len(self._tokens)
+
+    def __contains__(self, row: int):
+        return bool(self.get(row))
+
+    def frontier(self) -> int:
+        return self._frontier
+
+    def version(self, row: int) -> int:
+        """
+        Lex the row first if it is not up to date
+        :return: Value that changes whenever the tokens of the row change
+        """
+        if not 0 <= row < len(self._versions):
+            return 0
+        self.get(row)
+        return self._versions[row]
+
+    def take_changed(self):
+        """
+        :return: Rows that were not edited whose tokens changed since the last call
+        """
+        changed = sorted(self._changed)
+        self._changed.clear()
+        return changed
+
+    def get(self, row: int, default=None):
+        """
+        :return: List of (column, length, token type name) of the row's tokens
+        """
+        if row < 0 or row >= len(self._tokens):
+            return default
+        if row >= self._frontier:
+            if row - self._frontier < LEX_AHEAD:
+                self.lex_ahead(row + 1 - self._frontier)
+            else:
+                previous = row - 1
+                start = self._ends[previous] if self._tokens[previous] is not None else 0
+                if self._tokens[row] is None or self._starts[row] != start:
+                    self._lexed = min(self._lexed, row)
+                    self._lex(row, start)
+        return self._tokens[row] or default
+
+    def extend_spans(self, row: int, line, spans: list, colors: Dict[str, int], default: int):
+        """
+        Append the (start, end, color) visual columns of the row's tokens to spans
+        """
+        items = self.get(row)
+        if items:
+            extend_item_spans(items, line, spans, colors, default)
+
+    def _lex(self, row: int, start: int):
+        tokens, self._ends[row] = self._grammar.lex(self._text(row), start)
+        if tokens != self._tokens[row]:
+            self._versions[row] = next(_versions)
+            # Rows without a start state are new or edited, so they are redrawn anyway
+            if self._starts[row] is not None:
+                self._changed.add(row)
+            self._tokens[row] = tokens
+        self._starts[row] = start
+
+    def lex_ahead(self, rows: int) -> bool:
+        """
+        Move the frontier forward by up to rows rows
+        :return: True if there are rows left to lex
+        """
+        starts, ends, tokens = self._starts, self._ends, self._tokens
+        row = self._frontier
+        end = min(len(tokens), row + rows)
+        state = ends[row - 1] if row > 0 else 0
+        while row < end:
+            if tokens[row] is None or starts[row] != state:
+                self._lex(row, state)
+            elif row < self._lexed:
+                row = self._lexed
+                break
+            state = ends[row]
+            row += 1
+        self._frontier = row
+        self._lexed = max(self._lexed, row)
+        return row < len(tokens)
+
+    def _shift_changed(self, row: int, n: int):
+        if self._changed:
+            self._changed = {r + n if r >= row else r for r in self._changed if not row + n <= r < row}
+
+    def _insert(self, row: int, n: int):
+        self._shift_changed(row, n)
+        if self._lexed > row:
+            self._lexed += n
+        self._starts[row:row] = [None] * n
+        self._ends[row:row] = [0] * n
+        self._tokens[row:row] = [None] * n
+        self._versions[row:row] = [0] * n
+
+    def _delete(self, row: int, n: int):
+        self._shift_changed(row + n, -n)
+        if self._lexed > row:
+            self._lexed = max(row, self._lexed - n)
+        del self._starts[row:row + n]
+        del self._ends[row:row + n]
+        del self._tokens[row:row + n]
+        del self._versions[row:row + n]
+
+    def apply(self, edit):
+        """
+        Invalidate the rows touched by an edit of the document
+        """
+        edit_type = type(edit)
+        y = edit.y
+        frontier = self._frontier
+        if frontier < y:
+            # Rows lexed past the edited row no longer follow one another
+            self._lexed = min(self._lexed, y)
+        elif frontier < self._lexed and self._starts[frontier] != self._ends[frontier - 1]:
+            # Lexing stopped at the frontier before the states converged
+            self._lexed = frontier
+        if edit_type is SplitLine:
+            self._insert(y + 1, 1)
+        elif edit_type is JoinLines:
+            self._delete(y + 1, 1)
+        elif edit_type is InsertBlock:
+            self._insert(y + 1, edit.end_y - y)
+        elif edit_type is DeleteRange:
+            self._delete(y + 1, edit.end_y - y)
+        elif edit_type is DeleteLine:
+            self._delete(y, 1)
+        elif edit_type is InsertLine:
+            self._insert(y, 1)
+        elif edit_type is not InsertText and edit_type is not DeleteText:
+            raise TypeError(f'Unknown edit {edit_type.__name__}')
+        if y < len(self._tokens):
+            self._starts[y] = None
+        self._frontier = min(self._frontier, y)
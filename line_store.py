@@ -0,0 +1,203 @@
+import hashlib
+import mmap
+from array import array
+from collections import OrderedDict
+from itertools import accumulate, count
+from operator import add
+from block_list import BlockList
+from visual_line import VisualLine
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+CACHE_SIZE = 1024
+SCAN_CHUNK_SIZE = 16 << 20
+
+
+def _newline_ends_numpy(data, pos: int, size: int) -> bytes:
+    chunk = numpy.frombuffer(data, numpy.uint8, size, pos)
+    return (numpy.flatnonzero(chunk == 10) + (pos + 1)).astype(numpy.int64).tobytes()
+
+
+def _newline_ends(data, pos: int, size: int, newline):
+    pieces = data[pos:pos + size].split(newline)
+    pieces.pop()
+    return map(add, accumulate(map(len, pieces)), count(pos + 1))
+
+
+def line_offsets(data, newline) -> array:
+    """
+    Index the lines of data a chunk at a time, without a Python step per line
+    :return: Offset of every line start, then one past the end of the last line
+    """
+    offsets = array('q', [0])
+    for pos in range(0, len(data), SCAN_CHUNK_SIZE):
+        size = min(SCAN_CHUNK_SIZE, len(data) - pos)
+        if numpy is not None and newline == b'\n':
+            offsets.frombytes(_newline_ends_numpy(data, pos, size))
+        else:
+            offsets.extend(_newline_ends(data, pos, size, newline))
+    if offsets[-1] < len(data):
+        offsets.append(len(data) + 1)
+    return offsets
+
+
+class TextSource:
+    """
+    Immutable text a document was loaded from.
+    Lines are addressed through an offset index, so untouched lines
+    cost a single array entry instead of a VisualLine object.
+    """
+
+    def __init__(self, text: str):
+        self._text = text
+        self._offsets = line_offsets(text, '\n')
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def line(self, index: int) -> str:
+        return self._text[self._offsets[index]:self._offsets[index + 1] - 1].rstrip()
+
+    def close(self):
+        pass
+
+
+class MappedSource:
+    """
+    Memory mapped file a document was loaded from.
+    Only the newline offset index is built up front; lines are
+    decoded when they are first read.
+    """
+
+    def __init__(self, path: str, encoding: str):
+        with open(path, 'rb') as f:
+            self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._encoding = encoding
+        self._digest = None
+        self._offsets = line_offsets(self._data, b'\n')
+
+    def digest(self) -> bytes:
+        """
+        SHA-1 of the mapped file, computed on first use
+        """
+        if self._digest is None:
+            digest = hashlib.sha1()
+            for pos in range(0, len(self._data), 1 << 20):
+                digest.update(self._data[pos:pos + (1 << 20)])
+            self._digest = digest.digest()
+        return self._digest
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def line(self, index: int) -> str:
+        data = self._data[self._offsets[index]:self._offsets[index + 1] - 1]
+        return data.decode(self._encoding, errors='replace').rstrip()
+
+    def close(self):
+        self._data.close()
+
+
+class LineStore(BlockList):
+    """
+    Rope of line blocks backing a Document.
+    A block is either a range of untouched source lines, or a list whose
+    entries are source line indices or edited VisualLine objects.
+    """
+
+    def __init__(self, source=None):
+        if source is not None and len(source) > 0:
+            super().__init__(len(source))
+        else:
+            super().__init__()
+            self.insert(0, [VisualLine('')])
+        self._source = source
+        self._cache = OrderedDict()
+
+    def _source_line(self, index: int) -> VisualLine:
+        line = self._cache.get(index)
+        if line is None:
+            line = VisualLine(self._source.line(index))
+            self._cache[index] = line
+            if len(self._cache) > CACHE_SIZE:
+                self._cache.popitem(last=False)
+        else:
+            self._cache.move_to_end(index)
+        return line
+
+    def get(self, y: int) -> VisualLine:
+        b, i = self._locate(y)
+        entry = self._blocks[b][i]
+        if isinstance(entry, int):
+            return self._source_line(entry)
+        return entry
+
+    def text(self, y: int) -> str:
+        b, i = self._locate(y)
+        entry = self._blocks[b][i]
+        if isinstance(entry, int):
+            return self._source.line(entry)
+        return entry.get_logical_text()
+
+    def materialize(self, y: int) -> VisualLine:
+        """
+        Get a line for editing.  Source lines are replaced in the
+        store by their own VisualLine, so edits are never lost to the cache.
+        """
+        b, i = self._locate(y)
+        block = self._list_block(b)
+        entry = block[i]
+        if isinstance(entry, int):
+            line = self._cache.pop(entry, None)
+            if line is None:
+                line = VisualLine(self._source.line(entry))
+            block[i] = entry = line
+        return entry
+
+    def source_digest(self) -> bytes:
+        return self._source.digest()
+
+    def close(self):
+        """
+        Release the source; the store must not be read afterwards
+        """
+        if self._source is not None:
+            self._source.close()
+
+    def snapshot(self):
+        """
+        Capture the current lines for reading on another thread.
+        Untouched blocks are shared and edited lines are captured as text,
+        so the cost is proportional to the edited blocks only.
+        :return: Generator of the captured line texts
+        """
+        blocks = [block if isinstance(block, range) else
+                  [entry if isinstance(entry, int) else entry.get_logical_text() for entry in block]
+                  for block in self._blocks]
+        return self._snapshot_texts(self._source, blocks)
+
+    @staticmethod
+    def _snapshot_texts(source, blocks):
+        for block in blocks:
+            if isinstance(block, range):
+                for index in block:
+                    yield source.line(index)
+            else:
+                for entry in block:
+                    yield source.line(entry) if isinstance(entry, int) else entry
+
+    def texts(self):
+        source = self._source
+        for block in self._blocks:
+            if isinstance(block, range):
+                for index in block:
+                    yield source.line(index)
+            else:
+                for entry in block:
+                    if isinstance(entry, int):
+                        yield source.line(entry)
+                    else:
+                        yield entry.get_logical_text()
@@ -0,0 +1,65 @@
+import os
+from pathlib import Path
+from typing import Dict, List
+from lspclient.client import LSPClient
+
+# Document version LSPClient sends with textDocument/didOpen
+OPEN_VERSION = 1
+
+
+def _uri(path: str) -> str:
+    return Path(os.path.abspath(path)).as_uri()
+
+
+class EditorLSPClient(LSPClient):
+    """
+    LSPClient with the protocol messages the editor needs on top of the
+    ones LSPClient wraps, built on its send_notification and send_request
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._versions: Dict[str, int] = {}
+
+    def open_source_file(self, path: str):
+        super().open_source_file(path)
+        self._versions[path] = OPEN_VERSION
+
+    def close_source_file(self, path: str):
+        self._versions.pop(path, None)
+        super().close_source_file(path)
+
+    def modify_source_changes(self, path: str, changes: List[dict]):
+        """
+        Notify the server of ranged content changes, in the order they were made.
+        The document version goes up by one from the one sent with didOpen.
+        """
+        version = self._versions.get(path, OPEN_VERSION) + 1
+        self._versions[path] = version
+        self.send_notification('textDocument/didChange', {
+            'textDocument': {'uri': _uri(path), 'version': version},
+            'contentChanges': changes,
+        })
+
+    def supports_coloring_range(self) -> bool:
+        """
+        :return: Whether the server announced semanticTokensProvider.range
+        """
+        provider = self.capabilities.get('semanticTokensProvider') or {}
+        return bool(provider.get('range'))
+
+    def request_coloring_range(self, path: str, top: int, bottom: int, callback):
+        """
+        Request the semantic tokens of rows top to bottom (exclusive)
+        :return: Request id
+        """
+        return self.send_request('textDocument/semanticTokens/range', {
+            'textDocument': {'uri': _uri(path)},
+            'range': {'start': {'line': top, 'character': 0}, 'end': {'line': bottom, 'character': 0}},
+        }, callback)
+
+    def cancel_request(self, request_id):
+        """
+        Tell the server a request's result is no longer needed
+        """
+        self.send_notification('$/cancelRequest', {'id': request_id})
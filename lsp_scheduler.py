@@ -0,0 +1,117 @@
+import functools
+import time
+from collections import defaultdict
+
+
+class RequestStats:
+    __slots__ = ('scheduled', 'superseded', 'sent', 'cancelled', 'completed', 'dropped',
+                 'total_latency', 'max_latency')
+
+    def __init__(self):
+        self.scheduled = 0
+        self.superseded = 0
+        self.sent = 0
+        self.cancelled = 0
+        self.completed = 0
+        self.dropped = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def add_latency(self, latency: float):
+        self.completed += 1
+        self.total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+
+    def as_dict(self) -> dict:
+        res = {name: getattr(self, name) for name in self.__slots__}
+        res['avg_latency'] = self.total_latency / self.completed if self.completed else 0.0
+        return res
+
+
+class _Request:
+    __slots__ = ('version', 'sent_at', 'request_id')
+
+    def __init__(self, version, sent_at: float):
+        self.version = version
+        self.sent_at = sent_at
+        self.request_id = None
+
+
+class LspScheduler:
+    """
+    Issues LSP requests on behalf of the Application.
+    Requests of one kind for one file are debounced, so only the last of a
+    burst is sent; sending a request cancels the one still in flight, and
+    responses are handed over only if they answer the latest request and
+    the document did not change since it was sent.
+    """
+
+    def __init__(self, app, client):
+        self._app = app
+        self._client = client
+        self._timers = {}
+        self._in_flight = {}
+        self._stats = defaultdict(RequestStats)
+
+    def schedule(self, kind: str, path: str, delay: float, send, handler, version):
+        """
+        :param kind: Request type, debounced and cancelled separately per path
+        :param delay: Seconds without another schedule of the same request before it is sent
+        :param send: Called with the response callback to issue the request.  May return the request id.
+        :param handler: Called with the response, unless it is out of date
+        :param version: Function returning the document version
+        """
+        key = (kind, path)
+        stats = self._stats[kind]
+        stats.scheduled += 1
+        timer = self._timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+            stats.superseded += 1
+        if delay > 0:
+            self._timers[key] = self._app.call_later(delay, self._send, key, send, handler, version)
+        else:
+            self._send(key, send, handler, version)
+
+    def cancel(self, path: str):
+        """
+        Forget everything pending for path
+        """
+        for key in [key for key in self._timers if key[1] == path]:
+            self._timers.pop(key).cancel()
+        for key in [key for key in self._in_flight if key[1] == path]:
+            self._cancel_in_flight(key)
+
+    def _cancel_in_flight(self, key):
+        request = self._in_flight.pop(key, None)
+        if request is not None:
+            self._stats[key[0]].cancelled += 1
+            if request.request_id is not None:
+                self._client.cancel_request(request.request_id)
+
+    def _send(self, key, send, handler, version):
+        self._timers.pop(key, None)
+        self._cancel_in_flight(key)
+        request = _Request(version(), time.monotonic())
+        self._in_flight[key] = request
+        self._stats[key[0]].sent += 1
+        callback = functools.partial(self._on_response, key, request, handler, version)
+        request.request_id = send(self._app.deferred(callback))
+
+    def _on_response(self, key, request, handler, version, msg):
+        stats = self._stats[key[0]]
+        if self._in_flight.get(key) is not request:
+            stats.dropped += 1
+            return
+        del self._in_flight[key]
+        stats.add_latency(time.monotonic() - request.sent_at)
+        if version() != request.version:
+            stats.dropped += 1
+            return
+        handler(msg)
+
+    def stats(self) -> dict:
+        """
+        :return: Counters and latencies in seconds per request kind
+        """
+        return {kind: stats.as_dict() for kind, stats in self._stats.items()}
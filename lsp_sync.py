@@ -0,0 +1,126 @@
+from collections import OrderedDict
+from undo import InsertText, DeleteText, SplitLine, JoinLines, InsertBlock, DeleteRange, DeleteLine, InsertLine
+
+
+def utf16_len(text: str) -> int:
+    if text.isascii():
+        return len(text)
+    return len(text.encode('utf-16-le')) // 2
+
+
+def _position(line: int, character: int) -> dict:
+    return {'line': line, 'character': character}
+
+
+def _doc_position(doc, y: int, x: int) -> dict:
+    if x == 0:
+        return _position(y, 0)
+    return _position(y, utf16_len(doc.get_row(y).get_logical_text()[0:x]))
+
+
+def _end_of(start: dict, text: str) -> dict:
+    lines = text.split('\n')
+    if len(lines) == 1:
+        return _position(start['line'], start['character'] + utf16_len(text))
+    return _position(start['line'] + len(lines) - 1, utf16_len(lines[-1]))
+
+
+def _change(start: dict, end: dict, text: str) -> dict:
+    return {'range': {'start': start, 'end': end}, 'text': text}
+
+
+def edit_change(doc, edit) -> dict:
+    """
+    Convert an edit into an LSP TextDocumentContentChangeEvent.
+    Called as the edit is recorded: the text before the edit position is
+    still as it was, and so are the line counts noted below.
+    """
+    edit_type = type(edit)
+    if edit_type is InsertText or edit_type is InsertBlock:
+        start = _doc_position(doc, edit.y, edit.x)
+        return _change(start, start, edit.text)
+    if edit_type is DeleteText or edit_type is DeleteRange:
+        start = _doc_position(doc, edit.y, edit.x)
+        return _change(start, _end_of(start, edit.text), '')
+    if edit_type is SplitLine:
+        start = _doc_position(doc, edit.y, edit.x)
+        return _change(start, start, '\n')
+    if edit_type is JoinLines:
+        return _change(_doc_position(doc, edit.y, edit.x), _position(edit.y + 1, 0), '')
+    if edit_type is DeleteLine:
+        # Recorded before the line is removed
+        if edit.y + 1 < doc.rows_count():
+            return _change(_position(edit.y, 0), _position(edit.y + 1, 0), '')
+        if edit.y > 0:
+            start = _position(edit.y - 1, utf16_len(doc.get_row(edit.y - 1).get_logical_text()))
+            return _change(start, _position(edit.y, utf16_len(edit.text)), '')
+        return _change(_position(0, 0), _position(0, utf16_len(edit.text)), '')
+    if edit_type is InsertLine:
+        # Recorded after the line is inserted
+        if edit.y + 1 < doc.rows_count():
+            return _change(_position(edit.y, 0), _position(edit.y, 0), edit.text + '\n')
+        if edit.y > 0:
+            start = _position(edit.y - 1, utf16_len(doc.get_row(edit.y - 1).get_logical_text()))
+            return _change(start, start, '\n' + edit.text)
+        return _change(_position(0, 0), _position(0, 0), edit.text)
+    raise TypeError(f'Unknown edit {edit_type.__name__}')
+
+
+def merge_change(last: dict, change: dict) -> bool:
+    """
+    Fold change into last when both are typing or deleting on one line
+    :return: True if merged
+    """
+    last_start, last_end = last['range']['start'], last['range']['end']
+    start, end = change['range']['start'], change['range']['end']
+    if start['line'] != last_start['line'] or end['line'] != start['line'] or last_end['line'] != start['line']:
+        return False
+    if '\n' in last['text'] or '\n' in change['text']:
+        return False
+    if last_start == last_end and start == end:
+        if start['character'] == last_start['character'] + utf16_len(last['text']):
+            last['text'] += change['text']
+            return True
+    elif not last['text'] and not change['text']:
+        if end == last_start:
+            last['range']['start'] = start
+            return True
+        if start == last_start:
+            last_end['character'] += end['character'] - start['character']
+            return True
+    return False
+
+
+class ChangeBatcher:
+    """
+    Collects the content changes of documents between flushes,
+    so a whole event loop turn is sent to the server as one notification
+    """
+
+    def __init__(self):
+        self._pending = OrderedDict()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, doc, edit):
+        path = doc.get_path()
+        entry = self._pending.get(path)
+        if entry is None:
+            entry = self._pending[path] = (doc, [])
+        change = edit_change(doc, edit)
+        changes = entry[1]
+        if not changes or not merge_change(changes[-1], change):
+            changes.append(change)
+
+    def discard(self, path: str):
+        self._pending.pop(path, None)
+
+    def flush(self, send):
+        """
+        :param send: Called with the path, document and list of changes of every modified document
+        """
+        pending = self._pending
+        self._pending = OrderedDict()
+        for path, (doc, changes) in pending.items():
+            send(path, doc, changes)
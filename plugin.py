@@ -29,6 +29,7 @@ class WindowPlugin(Plugin):
         super().__init__()
         self._window = Window(size)
         self._menu = Menu('')
+        self._render_state = None
 
     def set_menu(self, menu):
         self._menu = menu
@@ -48,6 +49,20 @@ class WindowPlugin(Plugin):
     def on_leave(self):
         self._window.set_border_type(0)
 
+    def invalidate(self):
+        self._render_state = None
+
+    def needs_render(self, *state) -> bool:
+        """
+        Check if anything that affects the window's contents changed
+        since the last time it was drawn
+        """
+        state = (self._window.render_key(),) + state
+        if state == self._render_state:
+            return False
+        self._render_state = state
+        return True
+
     def render(self):
         self._window.render()
 
@@ -129,6 +129,8 @@ class DirTreePlugin(WindowPlugin):
         return lines
 
     def render(self):
+        if not self.needs_render(self._offset, self._cur_y, id(self._all_lines), config.local_get_value('target')):
+            return
         super().render()
         w, h = self._window.width(), self._window.height()
         end_visible = min(len(self._all_lines), self._offset + h)
@@ -1,12 +1,9 @@
 import os
+import functools
 import subprocess as sp
 import config
 from plugin import Plugin
 from logger import logwrite
-import threading
-
-
-# import time
 
 
 class MakerPlugin(Plugin):
@@ -15,37 +12,52 @@ class MakerPlugin(Plugin):
         self._root = os.path.join(config.work_dir, 'build')
         self._offset = 0
         self._output_lines = []
-        self._stdout_thread = None
-        self._stderr_thread = None
-        self._terminate = False
+        self._process = None
+        self._open_streams = 0
+        self._on_done = None
 
-    def _output_loop(self, os):
-        output = config.get_app().get_plugin('output')
-        for line in os:
-            if self._terminate:
-                break
-            if isinstance(line, bytes):
-                line = line.decode('utf-8')
-            output.add_text(line.rstrip())
+    def _on_output(self, stream, pending: list):
+        """
+        Called by the event loop when a build pipe is readable
+        :param pending: Holds the incomplete last line read so far
+        """
+        app = config.get_app()
+        output = app.get_plugin('output')
+        data = os.read(stream.fileno(), 65536)
+        if data:
+            lines = (pending[0] + data).split(b'\n')
+            pending[0] = lines.pop()
+            for line in lines:
+                output.add_text_no_flush(line.decode('utf-8', errors='replace').rstrip())
+            return
+        app.remove_reader(stream.fileno())
+        stream.close()
+        if pending[0]:
+            output.add_text_no_flush(pending[0].decode('utf-8', errors='replace').rstrip())
+        self._open_streams -= 1
+        if self._open_streams == 0:
+            self._process.wait()
+            self._process = None
+            on_done = self._on_done
+            self._on_done = None
+            if on_done is not None:
+                on_done()
 
-    def _execute(self, args):
-        self._terminate = False
-        output = config.get_app().get_plugin('output')
+    def _execute(self, args, on_done=None):
+        """
+        Start a build command without waiting for it.  Its output is
+        read by the application's event loop as it arrives.
+        """
+        if self._process is not None:
+            return
+        app = config.get_app()
+        output = app.get_plugin('output')
         output.clear()
-        # if self._output_thread is None:
-        #    self._output_thread = threading.Thread(target=self._output_loop)
-        #    self._output_thread.start()
-        p = sp.Popen(args, stdout=sp.PIPE, stderr=sp.PIPE, cwd=self._root)
-        self._stdout_thread = threading.Thread(target=self._output_loop, args=(p.stdout,))
-        self._stderr_thread = threading.Thread(target=self._output_loop, args=(p.stderr,))
-        self._stdout_thread.start()
-        self._stderr_thread.start()
-        self._stdout_thread.join()
-        self._stderr_thread.join()
-        # self._terminate = True
-        # self._output_thread = None
-        self._stdout_thread = None
-        self._stderr_thread = None
+        self._process = sp.Popen(args, stdout=sp.PIPE, stderr=sp.PIPE, cwd=self._root)
+        self._on_done = on_done
+        self._open_streams = 2
+        for stream in (self._process.stdout, self._process.stderr):
+            app.add_reader(stream.fileno(), functools.partial(self._on_output, stream, [b'']))
 
     def global_action_configure(self):
         return self.action_configure()
@@ -57,8 +69,7 @@ class MakerPlugin(Plugin):
         except FileExistsError:
             pass
         try:
-            self._execute(['cmake', '-DCMAKE_BUILD_TYPE=Debug', '-GNinja', '..'])
-            self.action_make()
+            self._execute(['cmake', '-DCMAKE_BUILD_TYPE=Debug', '-GNinja', '..'], self.action_make)
         except FileNotFoundError:
             output.add_text('Failed to configure')
 
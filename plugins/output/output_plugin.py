@@ -1,4 +1,5 @@
 import re
+import threading
 import config
 from geom import Point
 from plugin import WindowPlugin
@@ -23,22 +24,18 @@ class OutputPlugin(WindowPlugin):
         self._view.set_cursor(Cursor(0, 0))
 
     def add_text(self, text: str):
-        text = text.split('\n')
-        for line in text:
-            self._view.insert_text(line)
-            self._view.action_enter()
-            self._view.action_select_home()
-            self._view.delete_selection()
+        if threading.current_thread() is not threading.main_thread():
+            config.get_app().post(self.add_text, text)
+            return
+        self.add_text_no_flush(text)
         self._view.render()
         self._window.flush()
 
     def add_text_no_flush(self, text: str):
-        text = text.split('\n')
-        for line in text:
-            self._view.insert_text(line)
-            self._view.action_enter()
-            self._view.action_select_home()
-            self._view.delete_selection()
+        last = self._doc.rows_count() - 1
+        end = Cursor(self._doc.get_row(last).get_logical_len(), last)
+        self._view.clear_selection()
+        self._view.set_cursor(self._doc.insert_block(end, text + '\n'))
 
     def flush(self):
         self._view.render()
@@ -72,6 +69,9 @@ class OutputPlugin(WindowPlugin):
     def render(self):
         self._view.render()
 
+    def invalidate(self):
+        self._view.invalidate()
+
     def on_action(self, action):
         self._view.on_action(action)
 
@@ -0,0 +1,273 @@
+import os
+import hashlib
+import locale
+import queue
+import struct
+import threading
+from cursor import Cursor
+from undo import Journal, Step, SAVE_ENTRY, STEP_ENTRY, encode_step, decode_step
+from line_store import TextSource
+import config
+import logger
+
+PATH_ENTRY = 3
+FULL_ENTRY = 4
+
+path_header = struct.Struct('<q')
+
+
+def recovery_dir() -> str:
+    return os.path.join(config.cfg_dir, 'recovery')
+
+
+def _file_digest(path: str) -> bytes:
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.digest()
+
+
+def _process_alive(pid: int) -> bool:
+    if pid == os.getpid():
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class Recovery:
+    """
+    Unsaved changes left behind by an editor that did not exit cleanly
+    """
+
+    def __init__(self, filename: str, path: str, entries: list):
+        self.filename = filename
+        self.path = path
+        self._entries = entries
+
+    def saved_text(self) -> str:
+        """
+        :return: Content of the file the changes apply to, split into lines as Document.load does
+        """
+        if not self.path:
+            return ''
+        with open(self.path, 'rb') as f:
+            source = TextSource(f.read().decode(locale.getpreferredencoding(False), errors='replace'))
+        return '\n'.join(source.line(i) for i in range(len(source)))
+
+    def apply(self, doc):
+        """
+        Redo the recovered changes on doc, which holds the file as it was
+        when the changes were made, as a single undoable step
+        """
+        doc.start_compound()
+        for kind, payload in self._entries:
+            if kind == STEP_ENTRY:
+                for edit in decode_step(payload).edits:
+                    edit.redo(doc)
+            elif kind == FULL_ENTRY:
+                last = doc.rows_count() - 1
+                doc.delete_range(0, 0, last, doc.get_row(last).get_logical_len())
+                doc.insert_block(Cursor(0, 0), payload.decode('utf-8', 'surrogatepass'))
+        doc.stop_compound()
+
+    def discard(self):
+        try:
+            os.unlink(self.filename)
+        except OSError:
+            pass
+
+
+def find_recoveries():
+    """
+    Scan the recovery directory for changes that can still be applied:
+    left by a process that is gone, to a file that was not changed since.
+    Several editors may have left changes to the same file.
+    :return: List of Recovery objects, the most recent first
+    """
+    res = []
+    directory = recovery_dir()
+    if not os.path.isdir(directory):
+        return res
+    for name in sorted(os.listdir(directory)):
+        filename = os.path.join(directory, name)
+        try:
+            journal = Journal(filename)
+        except BlockingIOError:
+            # Locked by the running editor that writes it
+            continue
+        except OSError as e:
+            logger.logwrite(f'Cannot read recovery file {name}: {e}')
+            continue
+        try:
+            entries = [(kind, bytes(payload)) for kind, payload in journal.entries()]
+            journal.close()
+            journal = None
+            if len(entries) < 2 or entries[0][0] != PATH_ENTRY or entries[1][0] != SAVE_ENTRY:
+                raise ValueError('Missing recovery header')
+            pid, = path_header.unpack_from(entries[0][1], 0)
+            if _process_alive(pid):
+                continue
+            path = entries[0][1][path_header.size:].decode('utf-8', 'surrogateescape')
+            digest = _file_digest(path) if path else hashlib.sha1().digest()
+            if digest != entries[1][1]:
+                raise ValueError(f'{path} changed since')
+            if len(entries) > 2:
+                res.append((os.path.getmtime(filename), Recovery(filename, path, entries[2:])))
+                continue
+        except (OSError, ValueError, struct.error) as e:
+            logger.logwrite(f'Dropping recovery file {name}: {e}')
+            if journal is not None:
+                journal.close()
+        try:
+            os.unlink(filename)
+        except OSError:
+            pass
+    res.sort(key=lambda item: item[0], reverse=True)
+    return [recovery for _, recovery in res]
+
+
+class _DocState:
+    __slots__ = ('key', 'path', 'generation', 'changes')
+
+    def __init__(self, key: str, path: str, generation: int, changes: int):
+        self.key = key
+        self.path = path
+        self.generation = generation
+        self.changes = changes
+
+
+class RecoverySnapshotter:
+    """
+    Every interval seconds, collects the edits made to modified documents
+    since the previous tick and hands them to a background thread, which
+    appends them to one file per document in the recovery directory.
+    Documents are never copied; each file holds the hash of the saved
+    content followed by the edits made since.
+    """
+
+    def __init__(self, app, interval: float):
+        self._app = app
+        self._interval = interval
+        self._docs = {}
+        self._untitled = 0
+        self._queue = queue.Queue()
+        self._timer = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        for doc in app.main_view.get_all_docs():
+            doc.track_edits()
+        self._schedule()
+
+    @staticmethod
+    def watch(doc):
+        """
+        Have doc keep its edits from now on, for the next snapshots
+        """
+        doc.track_edits()
+
+    def _schedule(self):
+        self._timer = self._app.call_later(self._interval, self.tick)
+
+    def _key(self, path: str) -> str:
+        if path:
+            # One file per editor, so instances editing the same file keep their own changes
+            return f"{hashlib.sha1(path.encode('utf-8', 'surrogateescape')).hexdigest()}-{os.getpid()}"
+        self._untitled += 1
+        return f'untitled-{os.getpid()}-{self._untitled}'
+
+    def tick(self):
+        docs = []
+        for doc in self._app.main_view.get_all_docs():
+            if doc not in docs:
+                docs.append(doc)
+        for doc in list(self._docs.keys()):
+            if doc not in docs or not doc.is_modified():
+                self._queue.put(('discard', self._docs.pop(doc).key))
+        for doc in docs:
+            doc.track_edits()
+            if doc.is_modified():
+                self._snapshot(doc)
+        self._schedule()
+
+    def _snapshot(self, doc):
+        state = self._docs.get(doc)
+        if state is not None and state.changes == doc.change_count():
+            return
+        if state is None or state.generation != doc.save_generation() or state.path != doc.get_path():
+            if state is not None:
+                self._queue.put(('discard', state.key))
+            state = _DocState(self._key(doc.get_path()), doc.get_path(), doc.save_generation(), 0)
+            self._docs[doc] = state
+            self._queue.put(('start', state.key, state.path, doc.base_digest()))
+        state.changes = doc.change_count()
+        edits = doc.take_edits()
+        if edits is None:
+            self._queue.put(('full', state.key, doc.snapshot()))
+        elif edits:
+            self._queue.put(('edits', state.key, edits))
+
+    def close(self):
+        """
+        Stop snapshotting and remove the recovery files, on a clean exit
+        """
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        for state in self._docs.values():
+            self._queue.put(('discard', state.key))
+        self._docs = {}
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        os.makedirs(recovery_dir(), 0o700, True)
+        journals = {}
+        while True:
+            job = self._queue.get()
+            if job is None:
+                break
+            try:
+                self._process(job, journals)
+            except (OSError, ValueError) as e:
+                logger.logwrite(f'Recovery snapshot failed: {e}')
+        for journal in journals.values():
+            journal.close()
+
+    @staticmethod
+    def _process(job, journals):
+        action, key = job[0], job[1]
+        if action == 'discard':
+            journal = journals.pop(key, None)
+            if journal is not None:
+                journal.close()
+            try:
+                os.unlink(os.path.join(recovery_dir(), key))
+            except FileNotFoundError:
+                pass
+            return
+        if action == 'start':
+            journal = journals.pop(key, None)
+            if journal is not None:
+                journal.close()
+            _, _, path, digest = job
+            journal = Journal(os.path.join(recovery_dir(), key))
+            journals[key] = journal
+            journal.truncate(0)
+            journal.append(PATH_ENTRY, path_header.pack(os.getpid()) + path.encode('utf-8', 'surrogateescape'))
+            journal.append(SAVE_ENTRY, digest())
+        journal = journals.get(key)
+        if journal is None:
+            return
+        if action == 'edits':
+            step = Step(Cursor())
+            step.edits = job[2]
+            journal.append(STEP_ENTRY, encode_step(step))
+        elif action == 'full':
+            journal.append(FULL_ENTRY, '\n'.join(job[2]).encode('utf-8', 'surrogatepass'))
+        journal.sync()
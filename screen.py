@@ -5,7 +5,9 @@ from builtins import staticmethod
 import config
 from base import Base
 from geom import Rect, Point
+from cell_buffer import CellBuffer
 import _curses
+from collections import deque
 
 os.environ.setdefault('ESCDELAY', '25')
 import curses
@@ -13,6 +15,13 @@ import curses
 color_names = [
 ]
 
+PASTE_KEY = 'KEY_PASTE'
+PASTE_START = '200~'
+PASTE_END = '\033[201~'
+PASTE_TIMEOUT = 1000
+# Keys keypad mode translates that can appear in pasted text
+PASTE_SPECIAL_KEYS = {curses.KEY_ENTER: '\n', curses.KEY_BACKSPACE: '\x7f'}
+
 
 class Screen(Base):
     def __init__(self):
@@ -24,13 +33,16 @@ class Screen(Base):
         curses.noecho()
         curses.raw()
         self._mouse_callback = None
+        self._pending_keys = deque()
+        self._pasted_text = ''
         self._scr.notimeout(False)
-        self._scr.timeout(30)
+        self._scr.timeout(0)
         self._scr.keypad(True)
         curses.mousemask(curses.ALL_MOUSE_EVENTS | curses.REPORT_MOUSE_POSITION)
         mx = self._scr.getmaxyx()
         self._size = mx[1], mx[0]
         self._rect = Rect(0, 0, self._size[0], self._size[1])
+        self._cells = CellBuffer(self._size[0], self._size[1])
         curses.start_color()
         # curses.use_default_colors()
         self._color_names = [
@@ -52,7 +64,7 @@ class Screen(Base):
             for pair in default_pairs:
                 curses.init_pair(i, config.get_int(f'fg{i}', pair[0]), config.get_int(f'bg{i}', pair[1]))
                 i = i + 1
-            while i < 32:
+            while i < 34:
                 curses.init_pair(i, config.get_int(f'fg{i}', random.randint(1, 31)),
                                  config.get_int(f'bg{i}', 0))
                 i += 1
@@ -62,6 +74,8 @@ class Screen(Base):
                        '\u2554\u2550\u2557\u2551 \u2551\u255a\u2550\u255d']
         self._tees = ['\u2533\u2523\u252b\u253b\u254b', '\u2566\u2560\u2563\u2569\u256c']
         sys.stdout.write('\033]12;yellow\007')
+        sys.stdout.write('\033[?2004h')
+        sys.stdout.flush()
         self.dbg = None  # open('/tmp/screen.log', 'w')
 
     @staticmethod
@@ -76,6 +90,10 @@ class Screen(Base):
     def query_colors(pair):
         return curses.pair_content(pair)
 
+    @staticmethod
+    def input_fd():
+        return sys.stdin.fileno()
+
     def set_mouse_callback(self, cb):
         self._mouse_callback = cb
 
@@ -88,32 +106,70 @@ class Screen(Base):
     def move(self, pos):
         if not isinstance(pos, Point):
             pos = Point(pos)
-        if self._rect.is_point_inside(pos):
-            self._scr.move(pos.y, pos.x)
-            return True
-        return False
+        return self._cells.move(pos.x, pos.y)
 
     def cursor_position(self):
-        return self._scr.getyx()
+        x, y = self._cells.position()
+        return y, x
 
     @staticmethod
     def cursor(state):
         curses.curs_set(1 if state else 0)
 
+    def write_at(self, x, y, text, color):
+        if self._cells.move(x, y):
+            self._cells.write(text, color)
+
     def write(self, text, color):
         # if self.dbg is not None:
         #    self.dbg.write(f'write("{text}",{color})\n')
         #    self.dbg.flush()
-        attr = 0
-        color = curses.color_pair(color | (attr & 0x7FFF))
-        # color = 12
+        if not isinstance(text, str):
+            text = chr(text)
+        self._cells.write(text, color)
+
+    def _emit(self, x, y, text, color):
+        attr = curses.color_pair(color)
         try:
-            if isinstance(text, str):
-                for i in range(0, len(text)):
-                    c = text[i]
-                    self._scr.addstr(c, color)
+            if y == self._size[1] - 1 and x + len(text) >= self._size[0]:
+                # Writing the bottom right cell with addstr fails, since the
+                # cursor cannot advance past it, so insert that cell instead
+                if len(text) > 1:
+                    self._scr.addstr(y, x, text[0:-1], attr)
+                self._scr.insstr(y, self._size[0] - 1, text[-1], attr)
             else:
-                self._scr.addch(text, color)
+                self._scr.addstr(y, x, text, attr)
+        except curses.error:
+            pass
+
+    def scroll_rect(self, rect: Rect, dy: int) -> bool:
+        """
+        Scroll the contents of a rectangle up by dy rows, or down if dy is
+        negative, so that only the rows scrolled in need to be drawn
+        :return: False if the terminal could not scroll it
+        """
+        if rect.pos.x != 0 or rect.width() != self.width():
+            # curses only uses the terminal's scroll region for full width
+            # regions and repaints narrower ones, so leave those to the caller
+            return False
+        try:
+            region = self._scr.derwin(rect.height(), rect.width(), rect.pos.y, rect.pos.x)
+            region.scrollok(True)
+            region.scroll(dy)
+            self._scr.touchline(rect.pos.y, rect.height())
+        except curses.error:
+            return False
+        self._cells.scroll(rect.pos.x, rect.pos.y, rect.width(), rect.height(), dy)
+        return True
+
+    def present(self):
+        """
+        Send the cells that changed since the last call to curses
+        """
+        self._cells.flush(self._emit)
+        x, y = self._cells.position()
+        try:
+            self._scr.move(y, x)
         except curses.error:
             pass
 
@@ -121,32 +177,21 @@ class Screen(Base):
         self.fill(rect.pos.x, rect.pos.y, rect.width(), rect.height(), c, clr)
 
     def fill(self, x0, y0, w, h, c, clr):
+        row = c * w
         for y in range(y0, y0 + h):
-            self.move((x0, y))
-            self.write(c * w, clr)
+            self.write_at(x0, y, row, clr)
 
     def draw_frame_box(self, rect: Rect, color: int, box):
-        self.move(rect.pos)
-        self.write(box[0], color)
-        for i in range(rect.width() - 2):
-            self.write(box[1], color)
-        self.write(box[2], color)
+        x0, x1 = rect.pos.x, rect.right() - 1
+        w = rect.width() - 2
+        self.write_at(x0, rect.pos.y, box[0] + box[1] * w + box[2], color)
         for y in range(rect.pos.y + 1, rect.bottom() - 1):
-            self.move(Point(rect.pos.x, y))
-            self.write(box[3], color)
-            self.move(Point(rect.right() - 1, y))
-            self.write(box[5], color)
-        self.move(Point(rect.pos.x, rect.bottom() - 1))
-        self.write(box[6], color)
-        for i in range(rect.width() - 2):
-            self.write(box[7], color)
-        self.write(box[8], color)
+            self.write_at(x0, y, box[3], color)
+            self.write_at(x1, y, box[5], color)
+        self.write_at(x0, rect.bottom() - 1, box[6] + box[7] * w + box[8], color)
 
     def draw_frame_text_tees(self, pos: Point, text: str, color: int, tees):
-        self.move(pos)
-        self.write(tees[2], color)
-        self.write(text, color)
-        self.write(tees[1], color)
+        self.write_at(pos.x, pos.y, tees[2] + text + tees[1], color)
 
     def draw_frame(self, rect: Rect, color: int, btype: int):
         self.draw_frame_box(rect, color, self._boxes[btype])
@@ -155,17 +200,67 @@ class Screen(Base):
         self.draw_frame_text_tees(pos, text, color, self._tees[btype])
 
     def refresh(self):
+        self.present()
         self._scr.refresh()
 
     def flush(self):
-        # curses.halfdelay(1)
+        self.refresh()
+
+    def unget_key(self, key):
+        self._pending_keys.append(key)
+
+    def get_pasted_text(self):
+        return self._pasted_text
+
+    def _read_paste(self):
+        """
+        Read bracketed paste content up to the end marker.
+        Waits for the rest of the paste to arrive, but gives up if the
+        terminal goes quiet without ending it.
+        """
+        keys = []
+        self._scr.timeout(PASTE_TIMEOUT)
         try:
-            return self._scr.getkey()
+            while True:
+                key = self._scr.get_wch()
+                if isinstance(key, int):
+                    key = PASTE_SPECIAL_KEYS.get(key)
+                    if key is None:
+                        continue
+                keys.append(key)
+                if key == '~' and ''.join(keys[-len(PASTE_END):]) == PASTE_END:
+                    del keys[-len(PASTE_END):]
+                    break
         except curses.error:
-            return 0
+            pass
+        finally:
+            self._scr.timeout(0)
+        return ''.join(keys).replace('\r\n', '\n').replace('\r', '\n')
+
+    def _read_csi(self):
+        """
+        After ESC [ check for the start of a bracketed paste.
+        Anything else is returned as Alt+[ followed by the keys read.
+        """
+        keys = []
+        try:
+            while len(keys) < len(PASTE_START):
+                keys.append(self._scr.getkey())
+                if keys[-1] != PASTE_START[len(keys) - 1]:
+                    break
+        except curses.error:
+            pass
+        if ''.join(keys) == PASTE_START:
+            self._pasted_text = self._read_paste()
+            return PASTE_KEY
+        self._pending_keys.extend(keys)
+        return 'Alt+['
 
     def getkey(self):
+        if self._pending_keys:
+            return self._pending_keys.popleft()
         key = None
+        self.present()
         try:
             key = self._scr.getkey()
             if key == "KEY_MOUSE":
@@ -175,7 +270,7 @@ class Screen(Base):
             if len(key) == 1 and ord(key[0]) == 27:
                 key = 'ESC'
                 next_key = self._scr.getkey()
-                key = "Alt+" + next_key
+                key = self._read_csi() if next_key == '[' else "Alt+" + next_key
         except curses.error as e:
             if e.args[0] == 'no input':
                 return key
@@ -184,6 +279,8 @@ class Screen(Base):
         return key
 
     def close(self):
+        sys.stdout.write('\033[?2004l')
+        sys.stdout.flush()
         curses.nocbreak()
         self._scr.keypad(0)
         curses.echo()
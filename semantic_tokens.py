@@ -0,0 +1,274 @@
+from array import array
+from bisect import bisect_left
+from itertools import accumulate
+from typing import Dict, List
+
+from block_list import BlockList
+from undo import InsertText, DeleteText, SplitLine, JoinLines, InsertBlock, DeleteRange, DeleteLine, InsertLine
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class SemanticTokens:
+    """
+    Semantic highlights of a document in columnar form.
+    Tokens are kept in flat arrays sorted by row; rows holds the rows that
+    have tokens and starts[i]:starts[i + 1] the range of row i's tokens.
+    """
+
+    def __init__(self, legend: List[str] = None, rows=None, starts=None, cols=None, lengths=None, types=None):
+        self._legend = legend if legend is not None else []
+        self._rows = rows if rows is not None else array('i')
+        self._starts = starts if starts is not None else array('i', [0])
+        self._cols = cols if cols is not None else array('i')
+        self._lengths = lengths if lengths is not None else array('i')
+        self._types = types if types is not None else array('i')
+
+    def __len__(self):
+        return len(self._cols)
+
+    def __contains__(self, row: int):
+        i = bisect_left(self._rows, row)
+        return i < len(self._rows) and self._rows[i] == row
+
+    def rows(self):
+        return self._rows
+
+    def get(self, row: int, default=None):
+        """
+        :return: List of (column, length, token type name) of the row's tokens
+        """
+        i = bisect_left(self._rows, row)
+        if i == len(self._rows) or self._rows[i] != row:
+            return default
+        legend = self._legend
+        n = len(legend)
+        start, end = self._starts[i], self._starts[i + 1]
+        return [(col, length, legend[t] if t < n else 'Unknown')
+                for col, length, t in zip(self._cols[start:end], self._lengths[start:end], self._types[start:end])]
+
+    def extend_spans(self, row: int, line, spans: list, colors: Dict[str, int], default: int):
+        """
+        Append the (start, end, color) visual columns of the row's tokens to
+        spans, reading the token arrays in place
+        """
+        i = bisect_left(self._rows, row)
+        if i == len(self._rows) or self._rows[i] != row:
+            return
+        legend = self._legend
+        n = line.get_visual_len()
+        cols, lengths, types = self._cols, self._lengths, self._types
+        for k in range(self._starts[i], self._starts[i + 1]):
+            start = line.get_visual_index(cols[k])
+            if start < 0:
+                break
+            end = line.get_visual_index(cols[k] + lengths[k])
+            t = types[k]
+            spans.append(start)
+            spans.append(end if end >= 0 else n)
+            spans.append(colors.get(legend[t] if t < len(legend) else 'Unknown', default))
+
+    @staticmethod
+    def decode(data, legend: List[str]) -> 'SemanticTokens':
+        """
+        Decode an LSP relative token array (5 integers per token) in one pass
+        over the whole array, with NumPy when it is installed
+        """
+        if len(data) < 5:
+            return SemanticTokens(legend)
+        if numpy is not None:
+            return SemanticTokens._decode_numpy(data, legend)
+        return SemanticTokens._decode_array(data, legend)
+
+    @staticmethod
+    def _decode_numpy(data, legend):
+        tokens = numpy.frombuffer(array('I', data), dtype=numpy.uint32).reshape(-1, 5).astype(numpy.int64)
+        delta_lines = tokens[:, 0]
+        delta_cols = tokens[:, 1]
+        token_rows = numpy.cumsum(delta_lines)
+        row_starts = numpy.flatnonzero(delta_lines)
+        if len(row_starts) == 0 or row_starts[0] != 0:
+            row_starts = numpy.concatenate(([0], row_starts))
+        col_sums = numpy.cumsum(delta_cols)
+        bases = (col_sums - delta_cols)[row_starts]
+        counts = numpy.diff(numpy.append(row_starts, len(tokens)))
+        cols = col_sums - numpy.repeat(bases, counts)
+
+        def to_array(values):
+            return array('i', values.astype(numpy.int32).tobytes())
+
+        return SemanticTokens(legend, to_array(token_rows[row_starts]),
+                              to_array(numpy.append(row_starts, len(tokens))),
+                              to_array(cols), to_array(tokens[:, 2]), to_array(tokens[:, 3]))
+
+    @staticmethod
+    def _decode_array(data, legend):
+        data = array('i', data)
+        delta_lines = data[0::5]
+        token_rows = array('i', accumulate(delta_lines))
+        cols = array('i', bytes(4 * len(delta_lines)))
+        starts = array('i')
+        col = 0
+        for i, (delta_line, delta_col) in enumerate(zip(delta_lines, data[1::5])):
+            if delta_line or i == 0:
+                starts.append(i)
+                col = delta_col
+            else:
+                col += delta_col
+            cols[i] = col
+        rows = array('i', (token_rows[i] for i in starts))
+        starts.append(len(delta_lines))
+        return SemanticTokens(legend, rows, starts, cols, data[2::5], data[3::5])
+
+
+def extend_item_spans(items, line, spans: list, colors: Dict[str, int], default: int):
+    """
+    Append the (start, end, color) visual columns of a row's
+    (column, length, token type name) items to spans
+    """
+    n = line.get_visual_len()
+    for col, length, token_type in items:
+        start = line.get_visual_index(col)
+        if start < 0:
+            break
+        end = line.get_visual_index(col + length)
+        spans.append(start)
+        spans.append(end if end >= 0 else n)
+        spans.append(colors.get(token_type, default))
+
+
+def _cut(items: list, x0: int, x1: int):
+    """
+    :return: Tokens before column x0, and tokens after column x1 moved to start at column 0
+    """
+    before = []
+    after = []
+    for col, length, token_type in items:
+        end = col + length
+        if col < x0:
+            before.append((col, min(end, x0) - col, token_type))
+        if end > x1:
+            start = max(col, x1)
+            after.append((start - x1, end - start, token_type))
+    return before, after
+
+
+def _join(items: list, others: list, dx: int) -> list:
+    """
+    :return: items followed by others moved dx columns, rejoining a token the two were cut from
+    """
+    others = [(col + dx, length, token_type) for col, length, token_type in others]
+    if items and others:
+        col, length, token_type = items[-1]
+        if col + length == others[0][0] and token_type == others[0][2]:
+            items = items[:-1]
+            others[0] = (col, length + others[0][1], token_type)
+    return items + others
+
+
+class SemanticHighlights(BlockList):
+    """
+    Semantic highlights kept parallel to the rows of a document.
+    Untouched rows are ranges of rows of the decoded SemanticTokens, and
+    rows touched by edits since hold their own list of tokens.  An edit
+    updates the rows it touches and splices the block holding them, instead
+    of moving every token below.
+    """
+
+    def __init__(self, tokens: SemanticTokens = None, rows: int = 0):
+        super().__init__(rows)
+        self._tokens = tokens if tokens is not None else SemanticTokens()
+
+    def __contains__(self, row: int):
+        if row < 0 or row >= self._size:
+            return False
+        b, i = self._locate(row)
+        entry = self._blocks[b][i]
+        if isinstance(entry, int):
+            return entry in self._tokens
+        return len(entry) > 0
+
+    def get(self, row: int, default=None):
+        """
+        :return: List of (column, length, token type name) of the row's tokens
+        """
+        if row < 0 or row >= self._size:
+            return default
+        b, i = self._locate(row)
+        entry = self._blocks[b][i]
+        if isinstance(entry, int):
+            return self._tokens.get(entry, default)
+        return entry if entry else default
+
+    def extend_spans(self, row: int, line, spans: list, colors: Dict[str, int], default: int):
+        """
+        Append the (start, end, color) visual columns of the row's tokens to spans
+        """
+        if row < 0 or row >= self._size:
+            return
+        b, i = self._locate(row)
+        entry = self._blocks[b][i]
+        if isinstance(entry, int):
+            self._tokens.extend_spans(entry, line, spans, colors, default)
+        else:
+            extend_item_spans(entry, line, spans, colors, default)
+
+    def _items(self, row: int) -> list:
+        return self.get(row, [])
+
+    def _set(self, row: int, items: list):
+        b, i = self._locate(row)
+        self._list_block(b)[i] = items
+
+    def replace(self, top: int, bottom: int, tokens: SemanticTokens):
+        """
+        Replace the highlights of rows top to bottom (exclusive) by those in tokens
+        """
+        for row in range(top, min(bottom, self._size)):
+            self._set(row, tokens.get(row, []))
+
+    def apply(self, edit):
+        """
+        Move the highlights along with an edit of the document
+        """
+        edit_type = type(edit)
+        y = edit.y
+        if y > self._size or (y == self._size and edit_type is not InsertLine):
+            return
+        if edit_type is InsertText:
+            x, n = edit.x, len(edit.text)
+            self._set(y, [(col + n if col >= x else col, length + n if col < x < col + length else length, token_type)
+                          for col, length, token_type in self._items(y)])
+        elif edit_type is DeleteText:
+            before, after = _cut(self._items(y), edit.x, edit.x + len(edit.text))
+            self._set(y, _join(before, after, edit.x))
+        elif edit_type is SplitLine:
+            before, after = _cut(self._items(y), edit.x, edit.x)
+            self._set(y, before)
+            self.insert(y + 1, [after])
+        elif edit_type is JoinLines:
+            if y + 1 < self._size:
+                self._set(y, _join(self._items(y), self._items(y + 1), edit.x))
+                self.delete(y + 1, 1)
+        elif edit_type is InsertBlock:
+            before, after = _cut(self._items(y), edit.x, edit.x)
+            if edit.end_y == y:
+                self._set(y, _join(before, after, edit.end_x))
+            else:
+                self._set(y, before)
+                rows = [[] for _ in range(edit.end_y - y - 1)]
+                rows.append(_join([], after, edit.end_x))
+                self.insert(y + 1, rows)
+        elif edit_type is DeleteRange:
+            if edit.end_y < self._size:
+                before = _cut(self._items(y), edit.x, edit.x)[0]
+                after = _cut(self._items(edit.end_y), edit.end_x, edit.end_x)[1]
+                self._set(y, _join(before, after, edit.x))
+                self.delete(y + 1, edit.end_y - y)
+        elif edit_type is DeleteLine:
+            self.delete(y, 1)
+        elif edit_type is InsertLine:
+            self.insert(y, [[]])
@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 import os
+import functools
 from typing import List, Dict, Optional
 from collections import defaultdict
 import json
@@ -7,7 +8,12 @@ import argh
 from cursor import Cursor
 from doc import Document
 from view import View
-from screen import Screen
+from screen import Screen, PASTE_KEY
+from events import EventLoop
+from recovery import RecoverySnapshotter, find_recoveries
+from lsp_sync import ChangeBatcher
+from lsp_scheduler import LspScheduler
+from semantic_tokens import SemanticTokens
 import wm
 from utils import *
 from plugin import *
@@ -23,9 +29,11 @@ from dialogs.color_dialog import ColorDialog
 from dialogs.find_dialog import FindDialog
 from dialogs.plugins_dialog import PluginsDialog
 from dialogs.wlist import ListWidget
-from lspclient.client import LSPClient
+from lsp_client import EditorLSPClient
 from data_types import *
 
+BURST_MAX_KEYS = 1 << 20
+
 
 class Application(Screen):
     def __init__(self):
@@ -39,16 +47,26 @@ class Application(Screen):
         wm.manager = wm.WindowManager(Rect(0, 1, self.width(), self.height() - 2))
         # self.window_manager =
         self.focus = None
+        self._chrome_dirty = True
+        self._overlay_drawn = False
         self.terminating = False
         self.modified = True
         self.active_plugins: Dict[str, Plugin] = {}
         self._root = config.work_dir
         self._last_key = ''
         self._get_new_suggestions = False
+        self._events = EventLoop()
+        self._recovery: Optional[RecoverySnapshotter] = None
+        self._lsp_changes = ChangeBatcher()
+        self._coloring_ranges = {}
+        self._range_coloring_failed = set()
+        self._lex_timer = None
+        self._events.add_reader(self.input_fd(), self._on_input_ready)
         try:
-            self.lsp = LSPClient(self._root, enable_logging=config.logging)
+            self.lsp = EditorLSPClient(self._root, enable_logging=config.logging)
         except FileNotFoundError:
             self.lsp = None
+        self._lsp_scheduler = LspScheduler(self, self.lsp) if self.lsp is not None else None
         FocusTarget.add(self)
         self._completion_list: Optional[ListWidget] = None
         self._completion_items: Dict[str, List[str]] = defaultdict(list)
@@ -59,9 +77,35 @@ class Application(Screen):
         config.local_set_value('open_docs', open_docs)
         super().close()
         if self.lsp is not None:
+            logger.logwrite(f'LSP request stats: {self._lsp_scheduler.stats()}')
             self.lsp.shutdown()
         for plugin_name in self.active_plugins:
             self.active_plugins[plugin_name].shutdown()
+        if self._recovery is not None:
+            self._recovery.close()
+        self._events.close()
+
+    def post(self, callback, *args):
+        self._events.post(callback, *args)
+
+    def deferred(self, callback):
+        """
+        Wrap a callback invoked from another thread (LSP responses),
+        so it runs on the event loop instead
+        """
+        return functools.partial(self._events.post, callback)
+
+    def call_later(self, delay: float, callback, *args):
+        return self._events.call_later(delay, callback, *args)
+
+    def add_reader(self, fd: int, callback):
+        self._events.add_reader(fd, callback)
+
+    def remove_reader(self, fd: int):
+        self._events.remove_reader(fd)
+
+    def _on_input_ready(self):
+        pass
 
     def on_mouse(self, eid, x, y, button):
         if self.main_view:
@@ -95,26 +139,95 @@ class Application(Screen):
         if open_count > 0:
             self.main_view.close_empty_tab()
 
-    def handle_full_coloring(self, msg):
-        self.main_view.get_doc().clear_semantic_highlight(-1)
-        self.handle_coloring(msg)
+    def recover_documents(self):
+        """
+        Offer to restore the unsaved changes left by an editor that crashed,
+        then start taking recovery snapshots
+        """
+        for item in find_recoveries():
+            name = item.path if item.path else 'a new file'
+            d = PromptDialog('Recovery', f'Recover unsaved changes to {name}?', ['Yes', 'No'])
+            self.focus = d
+            self.event_loop(True)
+            if d.get_result() == 'Yes':
+                doc = self._recovery_target(item)
+                if doc is not None:
+                    item.apply(doc)
+            item.discard()
+        interval = config.get_int('recovery_interval', 10)
+        if interval > 0:
+            self._recovery = RecoverySnapshotter(self, interval)
+
+    def _recovery_target(self, item):
+        """
+        :return: Document holding the file the recovered changes apply to.
+        If the file is open with changes already, such as those another
+        editor left, a new tab gets a copy of the saved file instead.
+        """
+        docs = [doc for doc in self.main_view.get_all_docs() if item.path and doc.get_path() == item.path]
+        if docs and not docs[0].is_modified():
+            return docs[0]
+        if item.path and not docs:
+            self.open_file(item.path)
+            doc = self.main_view.get_doc()
+            return doc if doc.get_path() == item.path else None
+        self.action_file_new()
+        doc = self.main_view.get_doc()
+        try:
+            text = item.saved_text()
+        except OSError:
+            return None
+        if text:
+            doc.insert_block(Cursor(0, 0), text)
+        return doc
+
+    def handle_full_coloring(self, msg, doc: Document = None):
+        self.handle_coloring(msg, doc)
+
+    def handle_range_coloring(self, msg, doc: Document, top: int, bottom: int):
+        """
+        Replace the semantic highlights of rows top to bottom of doc,
+        unless the whole document was colored since the request
+        """
+        self._coloring_ranges.pop(doc.get_path(), None)
+        if 'error' in msg:
+            logger.logwrite(msg['error'])
+            # Fall back to coloring the whole document rather than asking again
+            self._range_coloring_failed.add(doc.get_path())
+            self.modified = True
+            return
+        _, data = parse_coloring_message(msg)
+        if data is None or doc.has_full_semantic_highlights():
+            return
+        tokens, _ = self.lsp.get_coloring_legend()
+        doc.set_semantic_highlights(SemanticTokens.decode(data, tokens), top, bottom)
+        self.main_view.invalidate()
 
     def handle_row_coloring(self, msg):
         self.handle_coloring(msg)
 
-    def handle_coloring(self, msg):
+    def handle_coloring(self, msg, doc: Document = None):
+        """
+        Replace the semantic highlights of doc with the coloring in msg,
+        a full or delta semantic tokens result
+        """
         if self.lsp is None:
             return
+        if doc is None:
+            doc = self.main_view.get_doc()
         if 'error' in msg:
             logger.logwrite(msg['error'])
+            doc.set_semantic_tokens('', None)
             return
         tokens, _ = self.lsp.get_coloring_legend()
-        coloring, result_id = parse_coloring_message(msg, tokens)
-        self.main_view.set_coloring_id(result_id)
-        for item in coloring:
-            self.main_view.get_doc().clear_semantic_highlight(item.row)
-        for item in coloring:
-            self.main_view.get_doc().add_semantic_highlight(item.row, item.col, item.length, item.type_name)
+        result_id, data = parse_coloring_message(msg, doc.get_semantic_tokens())
+        doc.set_semantic_tokens(result_id, data)
+        if data is None:
+            # Delta edits against a result we do not have; ask for the whole array again
+            self.modified = True
+            return
+        doc.set_semantic_highlights(SemanticTokens.decode(data, tokens))
+        self.main_view.invalidate()
 
     def set_main_view(self, view):
         self.main_view = view
@@ -140,6 +253,7 @@ class Application(Screen):
     def save_before_close(self, docs: List[Document]):
         paths = []
         for doc in docs:
+            doc.wait_for_save()
             if doc.is_modified():
                 d = PromptDialog('Exit', 'Save file?', ['Yes', 'No', 'Cancel'])
                 self.focus = d
@@ -147,7 +261,7 @@ class Application(Screen):
                 r = d.get_result()
                 if r == 'Yes':
                     # TODO: Change to save current iter doc
-                    if not self.action_file_save():
+                    if not self.action_file_save(False):
                         return False
                 elif r == 'No':
                     pass
@@ -156,6 +270,10 @@ class Application(Screen):
             paths.append(doc.get_path())
         if self.lsp is not None:
             for path in paths:
+                self._lsp_changes.discard(path)
+                self._lsp_scheduler.cancel(path)
+                self._coloring_ranges.pop(path, None)
+                self._range_coloring_failed.discard(path)
                 self.lsp.close_source_file(path)
         return True
 
@@ -166,14 +284,14 @@ class Application(Screen):
         self.terminating = True
         return True
 
-    def action_file_save(self):
+    def action_file_save(self, background=True):
         if isinstance(self.main_view, View):
             doc = self.main_view.get_doc()
             filename = doc.get_filename()
             if not filename:
                 return self.action_file_save_as()
             else:
-                doc.save()
+                doc.save(background=background and doc.size() >= config.get_int('background_save_lines', 100000))
                 self.render()
             return True
 
@@ -185,6 +303,7 @@ class Application(Screen):
             r = d.get_result()
             if r == 'Save':
                 self.main_view.get_doc().save(d.get_path())
+                self.update_local_highlighting(self.main_view.get_doc())
                 self.render()
                 return True
         return False
@@ -192,13 +311,20 @@ class Application(Screen):
     def action_file_new(self):
         if isinstance(self.main_view, View):
             self.main_view.open_tab(Document('', self.main_view))
+            self._watch_edits(self.main_view.get_doc())
             self.render()
 
+    def _watch_edits(self, doc: Document):
+        if self._recovery is not None:
+            self._recovery.watch(doc)
+
     def open_file(self, path, row=-1, col=-1):
         try:
             self.main_view.open_tab(Document(path, self.main_view))
+            self._watch_edits(self.main_view.get_doc())
             if self.lsp is not None:
                 self.lsp.open_source_file(path)
+            self.update_local_highlighting(self.main_view.get_doc())
             self.set_focus(self.main_view)
             if row >= 0 and col >= 0:
                 row = min(row, self.main_view.get_doc().size() - 1)
@@ -274,6 +400,7 @@ class Application(Screen):
 
     def set_menu(self, bar):
         self.menu_bar = bar
+        self._chrome_dirty = True
         if len(bar.items) > 0:
             self.shortcuts['KEY_F(10)'] = bar.items[0]
 
@@ -282,9 +409,25 @@ class Application(Screen):
         if self.focus is None:
             self.set_focus(view)
 
+    def invalidate(self):
+        self._chrome_dirty = True
+        for view in self.views:
+            view.invalidate()
+
+    def _has_overlay(self) -> bool:
+        return self._completion_list is not None or not isinstance(self.focus, (View, Plugin))
+
     def render(self):
-        self.draw_menu_bar()
-        self.draw_status_bar()
+        # Dialogs, menus and the completion list are drawn over the views,
+        # so while one is up, and once more after it closes, draw everything.
+        overlay = self._has_overlay()
+        if overlay or self._overlay_drawn:
+            self.invalidate()
+        self._overlay_drawn = overlay
+        if self._chrome_dirty:
+            self._chrome_dirty = False
+            self.draw_menu_bar()
+            self.draw_status_bar()
         for view in self.views:
             if view is not self.focus:
                 view.render()
@@ -315,12 +458,76 @@ class Application(Screen):
 
     def close_modal(self):
         self.set_focus(self.views[0])
+        self.invalidate()
         self._modal = False
         self.cursor(True)
 
     def modal_result(self, result):
         pass
 
+    @staticmethod
+    def _is_text_key(key):
+        return len(key) == 1 and (32 <= ord(key) < 127 or key in '\n\t')
+
+    @staticmethod
+    def _is_movement_key(key):
+        action = config.keymap.get(key)
+        return action is not None and action.startswith(('move_', 'select_'))
+
+    def _read_burst(self, key, in_burst):
+        """
+        Collect the keys of the same kind already queued behind key
+        :param in_burst: Tells if a key belongs to the burst
+        """
+        keys = [key]
+        while len(keys) < BURST_MAX_KEYS:
+            key = self.getkey()
+            if key is None:
+                break
+            if not in_burst(key):
+                self.unget_key(key)
+                break
+            keys.append(key)
+        return keys
+
+    def _is_plain_text_key(self, key):
+        return isinstance(self.focus, View) and self.focus.is_plain_text_key(key) and \
+            key not in config.keymap and key not in self.shortcuts
+
+    def _type_keys(self, keys) -> bool:
+        """
+        Apply text keys typed ahead: each run of keys that only insert
+        themselves becomes a single edit, other keys go through process_key
+        """
+        start = 0
+        for i, key in enumerate(keys):
+            if self._is_plain_text_key(key):
+                continue
+            if start < i:
+                self._type_text(''.join(keys[start:i]))
+            if not self.process_key(key):
+                return False
+            start = i + 1
+        if start < len(keys):
+            self._type_text(''.join(keys[start:]))
+        return True
+
+    def _type_text(self, text: str):
+        self._last_key = text[-1]
+        self._get_new_suggestions = False
+        self.focus.type_text(text)
+        if self._get_new_suggestions:
+            self.post_modify()
+
+    def paste_text(self, text: str):
+        if isinstance(self.focus, View):
+            if text:
+                self.focus.paste_text(text)
+        else:
+            # Dialogs and plugins take pasted text as typed keys
+            for key in text:
+                self.process_key(key)
+
     def process_input(self):
         if self.terminating:
             return False
@@ -328,7 +535,23 @@ class Application(Screen):
         self._last_key = ''
         if key is None:
             self.on_no_input()
+            self._events.run_once()
+            return True
+        if key == PASTE_KEY:
+            self.paste_text(self.get_pasted_text())
             return True
+        if isinstance(self.focus, View) and self._is_text_key(key):
+            return self._type_keys(self._read_burst(key, self._is_text_key))
+        elif isinstance(self.focus, View) and self._is_movement_key(key):
+            # Under key repeat apply all the queued movements before rendering once
+            keys = self._read_burst(key, self._is_movement_key)
+            for key in keys[:-1]:
+                if not self.process_key(key):
+                    return False
+            key = keys[-1]
+        return self.process_key(key)
+
+    def process_key(self, key):
         if key == 'KEY_F(36)':
             return False
         if self.process_shortcuts(key):
@@ -349,17 +572,83 @@ class Application(Screen):
                     # logger.logwrite(f'key: {key}')
         return True
 
+    def update_local_highlighting(self, doc: Document):
+        """
+        Use the built-in lexer for files no language server colors
+        """
+        path = doc.get_path()
+        doc.set_local_highlighting(self.lsp is None or not self.lsp.is_open_file(path))
+        self._schedule_lexing()
+
+    def _schedule_lexing(self):
+        if self._lex_timer is None:
+            self._lex_timer = self.call_later(config.get_int('lex_delay_ms', 50) / 1000, self._lex_in_background)
+
+    def _lex_in_background(self):
+        """
+        Lex the document shown a chunk of rows at a time, while there is no input
+        """
+        self._lex_timer = None
+        doc = self.main_view.get_doc()
+        more = doc.lex_ahead(config.get_int('lex_chunk_rows', 500))
+        top, bottom = self.main_view.visible_rows()
+        for row in doc.take_changed_highlights():
+            if top <= row < bottom:
+                self.main_view.damage(row)
+        if more:
+            self._lex_timer = self.call_later(0, self._lex_in_background)
+
     def on_no_input(self):
         if self.modified:
-            doc = self.main_view.get_doc()
-            path = doc.get_path()
+            self._schedule_lexing()
+        if self.lsp is None:
+            self.modified = False
+            return
+        doc = self.main_view.get_doc()
+        path = doc.get_path()
+        if self.modified:
             if os.path.isfile(path):
-                if self.lsp is not None:
-                    self.lsp.request_coloring(path, '', self.handle_full_coloring)
+                delay = config.get_int('coloring_backfill_ms', 1000)
+                self._lsp_scheduler.schedule('coloring', path, delay / 1000,
+                                             functools.partial(self._request_coloring, path, doc),
+                                             functools.partial(self.handle_full_coloring, doc=doc),
+                                             doc.change_count)
             self.modified = False
+        if self.lsp.is_open_file(path) and path not in self._range_coloring_failed and \
+                self.lsp.supports_coloring_range():
+            self._request_visible_coloring(path, doc)
+
+    def _request_visible_coloring(self, path: str, doc: Document):
+        """
+        Color the rows around the window ahead of the whole document
+        """
+        top, bottom = self.main_view.visible_rows(config.get_int('coloring_margin', 100))
+        if doc.semantic_highlights_cover(top, bottom):
+            return
+        pending = self._coloring_ranges.get(path)
+        version = doc.change_count()
+        if pending is not None and pending[0] == version and pending[1] <= top and bottom <= pending[2]:
+            return
+        self._coloring_ranges[path] = (version, top, bottom)
+        self._lsp_scheduler.schedule('coloring_range', path, config.get_int('coloring_delay_ms', 150) / 1000,
+                                     functools.partial(self._request_coloring_range, path, top, bottom),
+                                     functools.partial(self.handle_range_coloring, doc=doc, top=top, bottom=bottom),
+                                     doc.change_count)
+
+    def _request_coloring(self, path: str, doc: Document, callback):
+        self.flush_lsp_changes()
+        return self.lsp.request_coloring(path, doc.get_last_coloring_id(), callback)
+
+    def _request_coloring_range(self, path: str, top: int, bottom: int, callback):
+        self.flush_lsp_changes()
+        return self.lsp.request_coloring_range(path, top, bottom, callback)
+
+    def _request_at_cursor(self, request, path: str, view, callback):
+        self.flush_lsp_changes()
+        cursor = view.get_cursor()
+        return request(path, cursor.y, cursor.x, callback)
 
     def on_modify(self, doc: Document, row: int):
-        path = doc.get_path()
         self.modified = True
         self._get_new_suggestions = True
         if self._completion_list:
@@ -368,12 +657,22 @@ class Application(Screen):
                 self._get_new_suggestions = False
                 if not self._last_key.isalnum():
                     self.close_suggestions()
-        if self.lsp is not None and self.lsp.is_open_file(path):
-            if row < 0:
-                self.lsp.modify_source_file(path, self.focus.get_doc().get_text(True))
-                # self.lsp.request_coloring(path, '', self.handle_full_coloring)
-            else:
-                self.lsp.modify_source_line(path, row, doc.get_row(row).get_logical_text())
+
+    def on_edit(self, doc: Document, edit):
+        if self.lsp is not None and self.lsp.is_open_file(doc.get_path()):
+            if len(self._lsp_changes) == 0:
+                self.post(self.flush_lsp_changes)
+            self._lsp_changes.add(doc, edit)
+
+    def flush_lsp_changes(self):
+        """
+        Send the edits batched since the last flush as incremental changes
+        """
+        if self.lsp is not None and len(self._lsp_changes) > 0:
+            self._lsp_changes.flush(self._send_lsp_changes)
+
+    def _send_lsp_changes(self, path: str, doc: Document, changes: List[dict]):
+        self.lsp.modify_source_changes(path, changes)
 
     def post_modify(self):
         if hasattr(self.focus, 'get_doc'):
@@ -403,18 +702,19 @@ class Application(Screen):
         doc: Document = self.focus.get_doc()
         path = doc.get_path()
         if self.lsp is not None and self.lsp.is_open_file(path):
-            cursor = self.focus.get_cursor()
-            col, row = cursor.x, cursor.y
-            self.lsp.request_definition(path, row, col, self.handle_definition)
+            self._lsp_scheduler.schedule('definition', path, 0,
+                                         functools.partial(self._request_at_cursor, self.lsp.request_definition,
+                                                           path, self.focus),
+                                         self.handle_definition, doc.change_count)
 
     def get_suggestions(self):
         doc: Document = self.focus.get_doc()
         path = doc.get_path()
         if self.lsp is not None and self.lsp.is_open_file(path):
-            # self.lsp.modify_source_file(path, doc.get_text(True))
-            cursor = self.focus.get_cursor()
-            col, row = cursor.x, cursor.y
-            self.lsp.request_completion(path, row, col, self.handle_suggestions)
+            self._lsp_scheduler.schedule('completion', path, config.get_int('completion_delay_ms', 50) / 1000,
+                                         functools.partial(self._request_at_cursor, self.lsp.request_completion,
+                                                           path, self.focus),
+                                         self.handle_suggestions, doc.change_count)
 
     def tip_rect(self):
         w, h = self._size
@@ -576,7 +876,9 @@ def main(filename: str = '', enable_logs=False):
     wm.manager.add_window(w)
     view = View(w, doc)
     app.set_main_view(view)
+    app.update_local_highlighting(doc)
     app.reopen_session()
+    app.recover_documents()
     app.render()
     view.redraw_all()
     error_report = ''
@@ -0,0 +1,595 @@
+import fcntl
+import mmap
+import os
+import struct
+from collections import deque
+from cursor import Cursor
+from visual_line import VisualLine
+
+RECORD_SIZE = 64
+
+STEP_ENTRY = 1
+SAVE_ENTRY = 2
+
+entry_header = struct.Struct('<BI')
+entry_trailer = struct.Struct('<I')
+step_header = struct.Struct('<qqI')
+int_field = struct.Struct('<q')
+text_length = struct.Struct('<I')
+
+
+class Edit:
+    """
+    Base of the undo log records.  Every record can revert itself and
+    apply itself again on a Document.
+    """
+    __slots__ = ()
+
+    def undo(self, doc):
+        raise NotImplementedError()
+
+    def redo(self, doc) -> Cursor:
+        raise NotImplementedError()
+
+    def merge(self, edit) -> bool:
+        return False
+
+    def size(self) -> int:
+        return RECORD_SIZE
+
+    def copy(self):
+        return type(self)(*(getattr(self, name) for name in self.__slots__))
+
+
+class InsertText(Edit):
+    __slots__ = ('y', 'x', 'text')
+
+    def __init__(self, y: int, x: int, text: str):
+        self.y = y
+        self.x = x
+        self.text = text
+
+    def undo(self, doc):
+        doc.delete_block(self.y, self.x, self.x + len(self.text))
+
+    def redo(self, doc) -> Cursor:
+        doc.insert_text(Cursor(self.x, self.y), self.text)
+        return Cursor(self.x + len(self.text), self.y)
+
+    def merge(self, edit) -> bool:
+        if type(edit) is not InsertText or edit.y != self.y or edit.x != self.x + len(self.text):
+            return False
+        if self.text[-1:].isspace() and not edit.text[:1].isspace():
+            return False
+        self.text += edit.text
+        return True
+
+    def size(self) -> int:
+        return RECORD_SIZE + len(self.text)
+
+
+class DeleteText(Edit):
+    __slots__ = ('y', 'x', 'text')
+
+    def __init__(self, y: int, x: int, text: str):
+        self.y = y
+        self.x = x
+        self.text = text
+
+    def undo(self, doc):
+        doc.insert_text(Cursor(self.x, self.y), self.text)
+
+    def redo(self, doc) -> Cursor:
+        doc.delete_block(self.y, self.x, self.x + len(self.text))
+        return Cursor(self.x, self.y)
+
+    def merge(self, edit) -> bool:
+        if type(edit) is not DeleteText or edit.y != self.y:
+            return False
+        if edit.x == self.x:
+            self.text += edit.text
+        elif edit.x + len(edit.text) == self.x:
+            self.x = edit.x
+            self.text = edit.text + self.text
+        else:
+            return False
+        return True
+
+    def size(self) -> int:
+        return RECORD_SIZE + len(self.text)
+
+
+class SplitLine(Edit):
+    __slots__ = ('y', 'x')
+
+    def __init__(self, y: int, x: int):
+        self.y = y
+        self.x = x
+
+    def undo(self, doc):
+        doc.join_next_row(self.y)
+
+    def redo(self, doc) -> Cursor:
+        doc.split_line(Cursor(self.x, self.y))
+        return Cursor(0, self.y + 1)
+
+
+class JoinLines(Edit):
+    __slots__ = ('y', 'x')
+
+    def __init__(self, y: int, x: int):
+        self.y = y
+        self.x = x
+
+    def undo(self, doc):
+        doc.split_line(Cursor(self.x, self.y))
+
+    def redo(self, doc) -> Cursor:
+        doc.join_next_row(self.y)
+        return Cursor(self.x, self.y)
+
+
+class InsertBlock(Edit):
+    __slots__ = ('y', 'x', 'end_y', 'end_x', 'text')
+
+    def __init__(self, y: int, x: int, end_y: int, end_x: int, text: str):
+        self.y = y
+        self.x = x
+        self.end_y = end_y
+        self.end_x = end_x
+        self.text = text
+
+    def undo(self, doc):
+        doc.delete_range(self.y, self.x, self.end_y, self.end_x)
+
+    def redo(self, doc) -> Cursor:
+        return doc.insert_block(Cursor(self.x, self.y), self.text)
+
+    def size(self) -> int:
+        return RECORD_SIZE + len(self.text)
+
+
+class DeleteRange(Edit):
+    __slots__ = ('y', 'x', 'end_y', 'end_x', 'text')
+
+    def __init__(self, y: int, x: int, end_y: int, end_x: int, text: str):
+        self.y = y
+        self.x = x
+        self.end_y = end_y
+        self.end_x = end_x
+        self.text = text
+
+    def undo(self, doc):
+        doc.insert_block(Cursor(self.x, self.y), self.text)
+
+    def redo(self, doc) -> Cursor:
+        doc.delete_range(self.y, self.x, self.end_y, self.end_x)
+        return Cursor(self.x, self.y)
+
+    def size(self) -> int:
+        return RECORD_SIZE + len(self.text)
+
+
+class DeleteLine(Edit):
+    __slots__ = ('y', 'text')
+
+    def __init__(self, y: int, text: str):
+        self.y = y
+        self.text = text
+
+    def undo(self, doc):
+        doc.insert(VisualLine(self.text), self.y)
+
+    def redo(self, doc) -> Cursor:
+        doc.delete_line(self.y)
+        return Cursor(0, self.y)
+
+    def size(self) -> int:
+        return RECORD_SIZE + len(self.text)
+
+
+class InsertLine(Edit):
+    __slots__ = ('y', 'text')
+
+    def __init__(self, y: int, text: str):
+        self.y = y
+        self.text = text
+
+    def undo(self, doc):
+        doc.delete_line(self.y)
+
+    def redo(self, doc) -> Cursor:
+        doc.insert(VisualLine(self.text), self.y)
+        return Cursor(0, self.y)
+
+    def size(self) -> int:
+        return RECORD_SIZE + len(self.text)
+
+
+EDIT_TYPES = [InsertText, DeleteText, SplitLine, JoinLines, InsertBlock, DeleteRange, DeleteLine, InsertLine]
+EDIT_CODES = {edit_type: code for code, edit_type in enumerate(EDIT_TYPES)}
+
+
+class Step:
+    """
+    Edits that are undone and redone together: a single record,
+    a run of coalesced typing, or everything inside a compound
+    """
+    __slots__ = ('cursor', 'edits', 'size', 'offset')
+
+    def __init__(self, cursor: Cursor):
+        self.cursor = cursor
+        self.edits = []
+        self.size = 0
+        self.offset = None
+
+    def add(self, edit: Edit, coalesce: bool):
+        if coalesce and self.edits:
+            last = self.edits[-1]
+            before = last.size()
+            if last.merge(edit):
+                self.size += last.size() - before
+                return
+        self.edits.append(edit)
+        self.size += edit.size()
+
+
+def encode_step(step: Step) -> bytes:
+    parts = [step_header.pack(step.cursor.x, step.cursor.y, len(step.edits))]
+    for edit in step.edits:
+        parts.append(bytes([EDIT_CODES[type(edit)]]))
+        for name in edit.__slots__:
+            value = getattr(edit, name)
+            if name == 'text':
+                data = value.encode('utf-8', 'surrogatepass')
+                parts.append(text_length.pack(len(data)))
+                parts.append(data)
+            else:
+                parts.append(int_field.pack(value))
+    return b''.join(parts)
+
+
+def decode_step(data) -> Step:
+    x, y, count = step_header.unpack_from(data, 0)
+    pos = step_header.size
+    step = Step(Cursor(x, y))
+    for _ in range(count):
+        edit_type = EDIT_TYPES[data[pos]]
+        pos += 1
+        args = []
+        for name in edit_type.__slots__:
+            if name == 'text':
+                n, = text_length.unpack_from(data, pos)
+                pos += text_length.size
+                args.append(bytes(data[pos:pos + n]).decode('utf-8', 'surrogatepass'))
+                pos += n
+            else:
+                args.append(int_field.unpack_from(data, pos)[0])
+                pos += int_field.size
+        step.add(edit_type(*args), False)
+    return step
+
+
+class Journal:
+    """
+    Append-only file with the undo steps and save checkpoints of one file.
+    Every entry ends with its length, so the journal is walked backwards
+    from the end through a memory map, and old steps are decoded only
+    when they are actually undone.
+    """
+
+    def __init__(self, path: str):
+        """
+        :raise OSError: If the journal cannot be opened or another editor has it open
+        """
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(self._fd)
+            raise
+        self._size = os.fstat(self._fd).st_size
+        self._unverified = 0
+        self._expected_digest = None
+        self._digest = None
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+    def size(self) -> int:
+        return self._size
+
+    def append(self, kind: int, payload: bytes) -> int:
+        offset = self._size
+        entry = entry_header.pack(kind, len(payload)) + payload + entry_trailer.pack(len(payload))
+        os.pwrite(self._fd, entry, offset)
+        self._size += len(entry)
+        return offset
+
+    def append_step(self, step: Step) -> int:
+        return self.append(STEP_ENTRY, encode_step(step))
+
+    def checkpoint(self, digest: bytes):
+        self.append(SAVE_ENTRY, digest)
+
+    def truncate(self, offset: int):
+        os.ftruncate(self._fd, offset)
+        self._size = offset
+        self._unverified = min(self._unverified, offset)
+
+    def compact(self, limit: int) -> int:
+        """
+        If the journal is larger than limit, drop its oldest entries until
+        it holds about half of that
+        :return: Number of bytes dropped from the start, by which later offsets moved
+        """
+        if self._size <= limit:
+            return 0
+        offset = 0
+        for kind, payload in self.entries():
+            if self._size - offset <= limit // 2:
+                break
+            offset += entry_header.size + len(payload) + entry_trailer.size
+        tail = os.pread(self._fd, self._size - offset, offset)
+        os.pwrite(self._fd, tail, 0)
+        self._unverified = max(0, self._unverified - offset)
+        self.truncate(len(tail))
+        return offset
+
+    def sync(self):
+        os.fsync(self._fd)
+
+    def entries(self):
+        """
+        Read the journal from the start
+        :return: Generator of the kind and payload of every entry
+        """
+        if self._size == 0:
+            return
+        with mmap.mmap(self._fd, self._size, access=mmap.ACCESS_READ) as data:
+            pos = 0
+            while pos + entry_header.size <= self._size:
+                kind, n = entry_header.unpack_from(data, pos)
+                start = pos + entry_header.size
+                if start + n + entry_trailer.size > self._size:
+                    raise ValueError('Corrupt undo journal')
+                yield kind, data[start:start + n]
+                pos = start + n + entry_trailer.size
+
+    def _last(self):
+        """
+        :return: Kind, payload and offset of the last entry, or None if the journal is empty
+        """
+        if self._size == 0:
+            return None
+        with mmap.mmap(self._fd, self._size, access=mmap.ACCESS_READ) as data:
+            n, = entry_trailer.unpack_from(data, self._size - entry_trailer.size)
+            offset = self._size - entry_trailer.size - n - entry_header.size
+            if offset < 0:
+                raise ValueError('Corrupt undo journal')
+            kind, length = entry_header.unpack_from(data, offset)
+            if length != n:
+                raise ValueError('Corrupt undo journal')
+            start = offset + entry_header.size
+            return kind, data[start:start + n], offset
+
+    def pop_step(self):
+        """
+        Remove the last step from the journal
+        :return: The decoded step, or None if there are no more steps
+        """
+        try:
+            while True:
+                last = self._last()
+                if last is None:
+                    return None
+                kind, payload, offset = last
+                if offset < self._unverified and not self._verify():
+                    return None
+                self.truncate(offset)
+                if kind == STEP_ENTRY:
+                    return decode_step(payload)
+        except (ValueError, IndexError, struct.error):
+            self.truncate(0)
+            return None
+
+    def _verify(self) -> bool:
+        """
+        Check the history written by an earlier session against the file
+        :return: True if it matches, otherwise the journal is emptied
+        """
+        expected, digest = self._expected_digest, self._digest
+        self._unverified = 0
+        self._expected_digest = self._digest = None
+        if digest() == expected:
+            return True
+        self.truncate(0)
+        return False
+
+    def reattach(self, digest) -> bool:
+        """
+        Drop the steps recorded after the last save checkpoint.  Whether the
+        history before it matches the file is checked when it is first undone.
+        :param digest: Function computing the hash of the file content as it is now
+        :return: True if there is a checkpoint to resume from, otherwise the journal is emptied
+        """
+        try:
+            while True:
+                last = self._last()
+                if last is None:
+                    return False
+                kind, payload, offset = last
+                if kind == SAVE_ENTRY:
+                    self._unverified = self._size
+                    self._expected_digest = bytes(payload)
+                    self._digest = digest
+                    return True
+                self.truncate(offset)
+        except (ValueError, struct.error):
+            pass
+        self.truncate(0)
+        return False
+
+
+class UndoLog:
+    """
+    Undo and redo history of a Document.
+    Holds at most budget bytes (estimated) of history, dropping the
+    oldest steps first, and keeps the journal under journal_limit bytes.
+    """
+
+    def __init__(self, budget: int, journal_limit: int = 64 << 20):
+        self._budget = budget
+        self._journal_limit = journal_limit
+        self._undo = deque()
+        self._redo = []
+        self._size = 0
+        self._open = None
+        self._depth = 0
+        self._sealed = True
+        self._journal = None
+
+    def size(self) -> int:
+        return self._size
+
+    def can_undo(self) -> bool:
+        return len(self._undo) > 0 or (self._journal is not None and self._journal.size() > 0)
+
+    def can_redo(self) -> bool:
+        return len(self._redo) > 0
+
+    def seal(self):
+        """
+        Make the next edit start a new step instead of extending the last one
+        """
+        self._sealed = True
+        self._persist()
+
+    def attach(self, journal: Journal):
+        """
+        Keep the history in journal from now on.  Steps already in the
+        journal are undone after the ones in memory.
+        """
+        self.close()
+        self._journal = journal
+        self._persist()
+
+    def close(self):
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+
+    def checkpoint(self, digest: bytes):
+        """
+        Mark the current state as saved, with digest the hash of the saved content
+        """
+        if self._journal is not None:
+            self.seal()
+            self._journal.checkpoint(digest)
+
+    def _persist(self):
+        if self._journal is None:
+            return
+        pending = []
+        for step in reversed(self._undo):
+            if step.offset is not None:
+                break
+            pending.append(step)
+        for step in reversed(pending):
+            step.offset = self._journal.append_step(step)
+        if self._journal.size() > self._journal_limit:
+            self._compact()
+
+    def _compact(self):
+        dropped = self._journal.compact(self._journal_limit)
+        if dropped:
+            # A step whose entry was dropped truncates the whole journal when undone
+            for step in self._undo:
+                if step.offset is not None:
+                    step.offset = max(0, step.offset - dropped)
+
+    def record(self, edit: Edit, cursor: Cursor):
+        self._redo.clear()
+        if self._open is not None:
+            self._open.add(edit, not self._sealed)
+        else:
+            top = self._undo[-1] if self._undo and not self._sealed else None
+            if top is not None and len(top.edits) == 1:
+                last = top.edits[0]
+                before = last.size()
+                if last.merge(edit):
+                    top.size += last.size() - before
+                    self._size += last.size() - before
+                    self._evict()
+                    return
+            step = Step(cursor.clone())
+            step.add(edit, False)
+            self._push(step)
+        self._sealed = False
+
+    def begin(self, cursor: Cursor):
+        self._depth += 1
+        if self._depth == 1:
+            self._open = Step(cursor.clone())
+            self._sealed = True
+
+    def end(self):
+        if self._depth == 0:
+            return
+        self._depth -= 1
+        if self._depth == 0:
+            step = self._open
+            self._open = None
+            if step.edits:
+                self._push(step)
+            self.seal()
+
+    def _push(self, step: Step):
+        self._persist()
+        self._undo.append(step)
+        self._size += step.size
+        self._evict()
+
+    def _evict(self):
+        while self._size > self._budget and len(self._undo) > 1:
+            self._size -= self._undo.popleft().size
+
+    def undo(self, doc):
+        """
+        Revert the latest step
+        :return: Cursor position before the step, or None if there was nothing to undo
+        """
+        self._sealed = True
+        if self._undo:
+            step = self._undo.pop()
+            self._size -= step.size
+            if step.offset is not None:
+                self._journal.truncate(step.offset)
+                step.offset = None
+        elif self._journal is not None:
+            step = self._journal.pop_step()
+            if step is None:
+                return None
+        else:
+            return None
+        for edit in reversed(step.edits):
+            edit.undo(doc)
+        self._redo.append(step)
+        return step.cursor.clone()
+
+    def redo(self, doc):
+        """
+        Apply the latest undone step again
+        :return: Cursor position after the step, or None if there was nothing to redo
+        """
+        self._sealed = True
+        if not self._redo:
+            return None
+        step = self._redo.pop()
+        cursor = None
+        for edit in step.edits:
+            cursor = edit.redo(doc)
+        self._push(step)
+        return cursor
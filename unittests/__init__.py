@@ -1,3 +1,11 @@
 import unittests.line
+import unittests.line_store
+import unittests.cell_buffer
+import unittests.undo
+import unittests.lsp_sync
+import unittests.semantic_tokens
+import unittests.lexer
+import unittests.view
 
-__all__ = [unittests.line]
+__all__ = [unittests.line, unittests.line_store, unittests.cell_buffer, unittests.undo, unittests.lsp_sync,
+           unittests.semantic_tokens, unittests.lexer, unittests.view]
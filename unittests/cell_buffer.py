@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+from cell_buffer import CellBuffer
+from termcolor import colored
+
+
+class TestTerminal:
+    def __init__(self, width: int, height: int):
+        self.rows = [[(' ', 0)] * width for _ in range(height)]
+        self.runs = 0
+
+    def emit(self, x: int, y: int, text: str, color: int):
+        self.runs += 1
+        for i, c in enumerate(text):
+            self.rows[y][x + i] = (c, color)
+
+    def scroll(self, x: int, y: int, width: int, height: int, dy: int):
+        region = [row[x:x + width] for row in self.rows[y:y + height]]
+        blank = [('?', 0)] * width
+        region = region[dy:] + [blank] * dy if dy > 0 else [blank] * -dy + region[:dy]
+        for i, cells in enumerate(region):
+            self.rows[y + i][x:x + width] = cells
+
+    def matches(self, cells: CellBuffer):
+        for y in range(cells.height()):
+            text = ''.join(c for c, _ in self.rows[y])
+            colors = [k for _, k in self.rows[y]]
+            if text != cells.row_text(y) or colors != list(cells.row_colors(y)):
+                return False
+        return True
+
+
+def unit_test():
+    from random import randint, seed
+    seed(1)
+    width, height = 40, 12
+    cells = CellBuffer(width, height)
+    term = TestTerminal(width, height)
+    cases = 2000
+    test_case = 0
+    while test_case < cases:
+        test_case += 1
+        for _ in range(randint(0, 5)):
+            cells.move(randint(0, width - 1), randint(0, height - 1))
+            text = ''.join(chr(randint(65, 70)) for _ in range(randint(1, 50)))
+            cells.write(text, randint(0, 3))
+        if randint(0, 50) == 0:
+            cells.invalidate()
+        if randint(0, 5) == 0:
+            x, y = randint(0, width - 2), randint(0, height - 2)
+            w, h = randint(1, width - x), randint(2, height - y)
+            dy = randint(1 - h, h - 1)
+            cells.flush(term.emit)
+            cells.scroll(x, y, w, h, dy)
+            term.scroll(x, y, w, h, dy)
+            for row in range(y + h - dy, y + h) if dy > 0 else range(y, y - dy):
+                cells.move(x, row)
+                cells.write('G' * w, 1)
+            term.runs = 0
+            cells.flush(term.emit)
+            if not term.matches(cells) or term.runs > abs(dy):
+                print(colored("FAILED cell scroll", 'red'))
+                break
+        cells.flush(term.emit)
+        if not term.matches(cells):
+            print(colored("FAILED cell flush", 'red'))
+            break
+        term.runs = 0
+        cells.flush(term.emit)
+        if term.runs != 0:
+            print(colored("FAILED idle flush", 'red'))
+            break
+    if test_case == cases:
+        print(colored("Cell buffer test Passed", 'green'))
+        return 0
+    return 1
+
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(unit_test())
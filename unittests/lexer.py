@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+from doc import Document
+from cursor import Cursor
+from lexer import PYTHON, IncrementalLexer
+from unittests.undo import StubView
+from termcolor import colored
+
+
+def full_lex(texts):
+    res = []
+    state = 0
+    for text in texts:
+        tokens, state = PYTHON.lex(text, state)
+        res.append(tokens)
+    return res
+
+
+def changes_test():
+    doc = Document('', StubView())
+    doc.insert_block(Cursor(0, 0), '\n'.join('x = 1' for _ in range(20)))
+    doc._path = 'test.py'
+    doc.set_local_highlighting(True)
+    lexer = doc.get_semantic_highlights()
+    lexer.get(19)
+    versions = [doc.highlights_version(row) for row in range(20)]
+    doc.insert_text(Cursor(0, 3), 'a')
+    if doc.lex_ahead(2):
+        return False
+    lexer.get(19)
+    if any(doc.highlights_version(row) != versions[row] for row in range(20) if row != 3) or \
+            doc.take_changed_highlights():
+        return False
+    versions = [doc.highlights_version(row) for row in range(20)]
+    doc.insert_text(Cursor(0, 5), '"""')
+    lexer.get(19)
+    changed = [row for row in range(20) if doc.highlights_version(row) != versions[row]]
+    return changed == list(range(5, 20)) and doc.take_changed_highlights() == list(range(6, 20))
+
+
+def unit_test():
+    from random import randint, choice, seed
+    seed(4)
+    doc = Document('', StubView())
+    doc.insert_block(Cursor(0, 0), '\n'.join(choice(['def f(x):', '    return x + 1  # one', 's = """', 'text',
+                                                     '"""', "t = '''", "'''", 'y = 0x1f']) for _ in range(3000)))
+    doc._path = 'test.py'
+    doc.set_local_highlighting(True)
+    lexer = doc.get_semantic_highlights()
+    if not isinstance(lexer, IncrementalLexer):
+        print(colored("FAILED local highlighting (no lexer)", 'red'))
+        return 1
+    lexer.get(2500)
+    for test_case in range(300):
+        y = randint(0, doc.rows_count() - 1)
+        x = randint(0, doc.get_row(y).get_logical_len())
+        action = randint(0, 5)
+        if action == 0:
+            doc.insert_text(Cursor(x, y), choice(['"""', "'''", '#', 'a']))
+        if action == 1:
+            doc.delete(Cursor(x, y))
+        if action == 2:
+            doc.split_line(Cursor(x, y))
+        if action == 3 and doc.rows_count() > 1:
+            doc.delete_line(y)
+        if action == 4:
+            doc.insert_block(Cursor(x, y), 'p\n"""q\nr')
+        if action == 5:
+            doc.undo()
+        top = randint(0, doc.rows_count() - 1)
+        for row in range(top, min(top + 40, doc.rows_count())):
+            lexer.get(row)
+        if test_case % 30 == 0:
+            while doc.lex_ahead(500):
+                pass
+            expected = full_lex(doc.get_text(True))
+            if [lexer.get(row, []) for row in range(doc.rows_count())] != expected:
+                print(colored("FAILED local highlighting", 'red'))
+                return 1
+    if not changes_test():
+        print(colored("FAILED local highlighting changes", 'red'))
+        return 1
+    print(colored("Lexer test Passed", 'green'))
+    return 0
+
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(unit_test())
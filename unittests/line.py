@@ -27,7 +27,7 @@ class TestLine:
                     self._visual2logical.append(i)
                 self._visual_text += ' ' * spaces
             else:
-                self._visual_text += c
+                self._visual_text += ' ' if c in '\r\v\f' else c
                 self._visual2logical.append(i)
         self._logical2visual.append(len(self._visual_text))
         self._visual2logical.append(len(self._logical_text))
@@ -75,7 +75,7 @@ class TestLine:
 
 
 def unit_test():
-    from random import randint, seed
+    from random import randint, choice, seed
     seed(1)
     tgt = VisualLine()
     ref = TestLine()
@@ -85,7 +85,7 @@ def unit_test():
         test_case += 1
         # if (test_case%1000)==0:
         #     print(ref)
-        action = randint(0, 8)
+        action = randint(0, 9)
         n = ref.get_logical_len()
         if action < 2:
             letter = chr(randint(65, 90))
@@ -97,6 +97,11 @@ def unit_test():
             pos = randint(0, n)
             ref.insert(pos, letter)
             tgt.insert(pos, letter)
+        if action == 5:
+            text = ''.join(chr(randint(65, 90)) if randint(0, 4) else choice('\t\t\r') for _ in range(randint(2, 12)))
+            pos = randint(0, n)
+            ref.insert(pos, text)
+            tgt.insert(pos, text)
         if action == 3:
             if n >= 40 or randint(0, 10) < 4:
                 pos = randint(0, n)
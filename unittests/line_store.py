@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+from line_store import LineStore, TextSource
+from visual_line import VisualLine
+from termcolor import colored
+
+
+def unit_test():
+    from random import randint, seed
+    seed(1)
+    ref = [f'line {i}' for i in range(5000)]
+    tgt = LineStore(TextSource('\n'.join(ref) + '\n'))
+    cases = 20000
+    test_case = 0
+    while test_case < cases:
+        test_case += 1
+        action = randint(0, 5)
+        n = len(ref)
+        if action == 0:
+            y = randint(0, n)
+            count = randint(1, 3) if randint(0, 10) > 0 else randint(600, 1200)
+            lines = [f'new {test_case}.{i}' for i in range(count)]
+            ref[y:y] = lines
+            tgt.insert(y, [VisualLine(s) for s in lines])
+        if action == 1 and n > 1:
+            y = randint(0, n - 1)
+            count = randint(1, 3) if randint(0, 10) > 0 else randint(1, 700)
+            del ref[y:y + count]
+            tgt.delete(y, count)
+        if action == 2 and n > 0:
+            y = randint(0, n - 1)
+            tgt.materialize(y).append('+')
+            ref[y] += '+'
+        if action == 3 and n > 0:
+            y = randint(0, n - 1)
+            if tgt.get(y).get_logical_text() != ref[y] or tgt.text(y) != ref[y]:
+                print(colored("FAILED line text", 'red'))
+                break
+        if len(tgt) != len(ref):
+            print(colored("FAILED line count", 'red'))
+            break
+        if action == 4 and list(tgt.texts()) != ref:
+            print(colored("FAILED texts", 'red'))
+            break
+    if test_case == cases:
+        print(colored("Line store test Passed", 'green'))
+        return 0
+    return 1
+
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(unit_test())
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+from doc import Document
+from cursor import Cursor
+from lsp_sync import ChangeBatcher
+from unittests.undo import StubView
+from termcolor import colored
+
+
+def apply_changes(lines, changes):
+    for change in changes:
+        start, end = change['range']['start'], change['range']['end']
+        text = '\n'.join(lines)
+        offsets = [0]
+        for line in lines:
+            offsets.append(offsets[-1] + len(line.encode('utf-16-le')) // 2 + 1)
+        units = text.encode('utf-16-le')
+        a = 2 * min(offsets[start['line']] + start['character'], len(units) // 2)
+        b = 2 * min(offsets[end['line']] + end['character'], len(units) // 2)
+        units = units[:a] + change['text'].encode('utf-16-le') + units[b:]
+        lines = units.decode('utf-16-le').split('\n')
+    return lines
+
+
+def unit_test():
+    from random import randint, choice, seed
+    seed(2)
+    doc = Document('', StubView())
+    doc.insert_block(Cursor(0, 0), 'first\nsecond \U0001F600 line\nthird')
+    mirror = doc.get_text(True)
+    batcher = ChangeBatcher()
+    doc.add_edit_callback(batcher.add)
+
+    def send(path, d, changes):
+        nonlocal mirror
+        mirror = apply_changes(mirror, changes)
+
+    cases = 3000
+    for test_case in range(cases):
+        y = randint(0, doc.rows_count() - 1)
+        x = randint(0, doc.get_row(y).get_logical_len())
+        action = randint(0, 7)
+        if action == 0:
+            doc.insert_text(Cursor(x, y), choice(['a', ' ', 'xy', 'é', '\U0001F600']))
+        if action == 1:
+            doc.delete(Cursor(x, y))
+        if action == 2:
+            doc.backspace(Cursor(x, y))
+        if action == 3:
+            doc.split_line(Cursor(x, y))
+        if action == 4 and doc.rows_count() > 1:
+            doc.delete_line(y)
+        if action == 5:
+            doc.insert_block(Cursor(x, y), 'p\n\U0001F600q\nr')
+        if action == 6 and y + 1 < doc.rows_count():
+            doc.delete_range(y, x, y + 1, 0)
+        if action == 7:
+            doc.undo()
+        if randint(0, 3) == 0:
+            batcher.flush(send)
+            if mirror != doc.get_text(True):
+                print(colored("FAILED LSP change sync", 'red'))
+                return 1
+    print(colored("LSP change sync test Passed", 'green'))
+    return 0
+
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(unit_test())
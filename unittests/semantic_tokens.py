@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+import semantic_tokens
+from semantic_tokens import SemanticTokens
+from doc import Document
+from cursor import Cursor
+from undo import InsertText, DeleteText, SplitLine, JoinLines, InsertBlock, DeleteRange, DeleteLine, InsertLine
+from unittests.undo import StubView
+from utils import parse_coloring_message
+from termcolor import colored
+
+
+def reference_decode(data, legend):
+    res = {}
+    row = col = 0
+    for i in range(0, len(data), 5):
+        if data[i]:
+            row += data[i]
+            col = 0
+        col += data[i + 1]
+        type_name = legend[data[i + 3]] if data[i + 3] < len(legend) else 'Unknown'
+        res.setdefault(row, []).append((col, data[i + 2], type_name))
+    return res
+
+
+def char_types(doc):
+    highlights = doc.get_semantic_highlights()
+    res = []
+    for y in range(doc.rows_count()):
+        row = [None] * doc.get_row(y).get_logical_len()
+        for col, length, type_name in highlights.get(y, []):
+            if col + length > len(row):
+                return None
+            row[col:col + length] = [type_name] * length
+        res.append(row)
+    return res
+
+
+def apply_to_chars(rows, edit):
+    """
+    Reference for SemanticHighlights.apply on one token type per character
+    """
+    edit_type = type(edit)
+    y = edit.y
+    if edit_type is InsertText:
+        row = rows[y]
+        x = edit.x
+        inside = row[x - 1] if 0 < x < len(row) and row[x - 1] == row[x] else None
+        row[x:x] = [inside] * len(edit.text)
+    elif edit_type is DeleteText:
+        del rows[y][edit.x:edit.x + len(edit.text)]
+    elif edit_type is SplitLine:
+        rows[y:y + 1] = [rows[y][:edit.x], rows[y][edit.x:]]
+    elif edit_type is JoinLines:
+        rows[y:y + 2] = [rows[y] + rows[y + 1]]
+    elif edit_type is InsertBlock:
+        lines = edit.text.split('\n')
+        new_rows = [[None] * len(line) for line in lines]
+        new_rows[0] = rows[y][:edit.x] + new_rows[0]
+        new_rows[-1] += rows[y][edit.x:]
+        rows[y:y + 1] = new_rows
+    elif edit_type is DeleteRange:
+        rows[y:edit.end_y + 1] = [rows[y][:edit.x] + rows[edit.end_y][edit.end_x:]]
+    elif edit_type is DeleteLine:
+        del rows[y]
+    elif edit_type is InsertLine:
+        rows.insert(y, [None] * len(edit.text))
+
+
+def shift_test():
+    from random import randint, choice
+    doc = Document('', StubView())
+    doc.insert_block(Cursor(0, 0), '\n'.join('abcdefghijklmnopqrstuvwxyz'[randint(0, 20):] for _ in range(200)))
+    data = []
+    last_row = 0
+    for y in range(doc.rows_count()):
+        x = last_x = 0
+        n = doc.get_row(y).get_logical_len()
+        while True:
+            x += randint(0, 6)
+            length = randint(1, 5)
+            if x + length > n:
+                break
+            data += [y - last_row, x - last_x, length, len(data) // 5, 0]
+            last_row, last_x = y, x
+            x += length
+    # A type per token, so the reference can tell adjacent tokens apart
+    doc.set_semantic_highlights(SemanticTokens.decode(data, [str(i) for i in range(len(data) // 5)]))
+    expected = char_types(doc)
+    doc.add_edit_callback(lambda d, edit: apply_to_chars(expected, edit))
+    for _ in range(1000):
+        y = randint(0, doc.rows_count() - 1)
+        x = randint(0, doc.get_row(y).get_logical_len())
+        action = randint(0, 7)
+        if action == 0:
+            doc.insert_text(Cursor(x, y), choice(['a', 'xy']))
+        if action == 1:
+            doc.delete(Cursor(x, y))
+        if action == 2:
+            doc.backspace(Cursor(x, y))
+        if action == 3:
+            doc.split_line(Cursor(x, y))
+        if action == 4 and doc.rows_count() > 1:
+            doc.delete_line(y)
+        if action == 5:
+            doc.insert_block(Cursor(x, y), 'p\nq\nr')
+        if action == 6 and y + 1 < doc.rows_count():
+            doc.delete_range(y, x, y + 1, min(2, doc.get_row(y + 1).get_logical_len()))
+        if action == 7:
+            doc.undo()
+        if char_types(doc) != expected:
+            return False
+    return len(doc.get_semantic_highlights()) == doc.rows_count()
+
+
+def unit_test():
+    from random import randint, seed
+    seed(3)
+    legend = ['namespace', 'type', 'function', 'variable']
+    decoders = [SemanticTokens._decode_array]
+    if semantic_tokens.numpy is not None:
+        decoders.append(SemanticTokens._decode_numpy)
+    for test_case in range(200):
+        data = []
+        for _ in range(randint(1, 300)):
+            data += [randint(0, 1) * randint(0, 3), randint(0, 20), randint(1, 10), randint(0, 5), 0]
+        expected = reference_decode(data, legend)
+        for decode in decoders:
+            tokens = decode(data, legend)
+            rows = [row for row in range(max(expected) + 2) if row in tokens]
+            if rows != sorted(expected) or any(tokens.get(row) != expected[row] for row in rows):
+                print(colored(f"FAILED semantic tokens decoding ({decode.__name__})", 'red'))
+                return 1
+    if not shift_test():
+        print(colored("FAILED semantic highlights shifting", 'red'))
+        return 1
+    if len(SemanticTokens.decode([], legend)) != 0:
+        print(colored("FAILED semantic tokens decoding (empty)", 'red'))
+        return 1
+    if len(parse_coloring_message({'result': None})[1]) != 0 or \
+            parse_coloring_message({'result': {'resultId': '2', 'edits': []}})[1] is not None:
+        print(colored("FAILED coloring message parsing", 'red'))
+        return 1
+    print(colored("Semantic tokens test Passed", 'green'))
+    return 0
+
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(unit_test())
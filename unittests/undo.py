@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+import os
+import tempfile
+from doc import Document
+from cursor import Cursor
+from undo import Journal, UndoLog, Step, InsertText
+from termcolor import colored
+
+
+class StubView:
+    def __init__(self):
+        self._cursor = Cursor()
+
+    def get_cursor(self):
+        return self._cursor
+
+    def set_cursor(self, cursor):
+        self._cursor = cursor
+
+
+def journal_step(i: int) -> Step:
+    step = Step(Cursor(i, 0))
+    step.add(InsertText(0, i, f'step {i}'), False)
+    return step
+
+
+def journal_test() -> bool:
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'journal')
+        journal = Journal(path)
+        for i in range(100):
+            journal.append_step(journal_step(i))
+        journal.checkpoint(b'saved')
+        journal.append_step(journal_step(100))
+        try:
+            Journal(path)
+            return False
+        except OSError:
+            pass
+        journal.close()
+        digests = []
+
+        def digest(content):
+            return lambda: digests.append(content) or content
+
+        journal = Journal(path)
+        if not journal.reattach(digest(b'other')) or digests or journal.pop_step() is not None or journal.size():
+            return False
+        journal.close()
+        journal = Journal(path)
+        for i in range(100):
+            journal.append_step(journal_step(i))
+        journal.checkpoint(b'saved')
+        journal.compact(journal.size() // 4)
+        if not journal.reattach(digest(b'saved')) or digests != [b'other']:
+            return False
+        journal.append_step(journal_step(100))
+        steps = [journal.pop_step() for _ in range(2)]
+        journal.close()
+        if [step.cursor.x for step in steps] != [100, 99] or digests != [b'other', b'saved']:
+            return False
+        doc = Document('', StubView())
+        doc._undo_log = UndoLog(1 << 20, 4096)
+        journal = Journal(os.path.join(directory, 'limited'))
+        doc._undo_log.attach(journal)
+        for i in range(500):
+            doc.insert_text(Cursor(0, 0), 'ab')
+            if journal.size() > 4096:
+                return False
+        for i in range(500):
+            doc.undo()
+        journal.close()
+        return doc.get_text() == '' and journal.size() == 0
+
+
+def unit_test():
+    from random import randint, choice, seed
+    seed(1)
+    doc = Document('', StubView())
+    for i, c in enumerate('hello world'):
+        doc.insert_text(Cursor(i, 0), c)
+    doc.undo()
+    if doc.get_text() != 'hello ':
+        print(colored("FAILED undo of coalesced typing", 'red'))
+        return 1
+    doc.redo()
+    if doc.get_text() != 'hello world':
+        print(colored("FAILED redo of coalesced typing", 'red'))
+        return 1
+    states = [doc.get_text()]
+    cases = 2000
+    for test_case in range(cases):
+        y = randint(0, doc.rows_count() - 1)
+        x = randint(0, doc.get_row(y).get_logical_len())
+        action = randint(0, 5)
+        if action == 0:
+            doc.insert_text(Cursor(x, y), choice(['a', ' ', 'xyz']))
+        if action == 1:
+            doc.delete(Cursor(x, y))
+        if action == 2:
+            doc.split_line(Cursor(x, y))
+        if action == 3 and doc.rows_count() > 1:
+            doc.delete_line(y)
+        if action == 4:
+            doc.insert_block(Cursor(x, y), 'p\nq\n\tr')
+        if action == 5 and y + 1 < doc.rows_count():
+            doc.delete_range(y, x, y + 1, 0)
+        text = doc.get_text()
+        if text == states[-1]:
+            continue
+        states.append(text)
+        doc.undo()
+        if doc.get_text() != states[-2]:
+            print(colored("FAILED undo", 'red'))
+            return 1
+        doc.redo()
+        if doc.get_text() != text:
+            print(colored("FAILED redo", 'red'))
+            return 1
+    while len(states) > 1:
+        states.pop()
+        doc.undo()
+    if doc.get_text() != states[0]:
+        print(colored("FAILED full undo", 'red'))
+        return 1
+    if not journal_test():
+        print(colored("FAILED undo journal", 'red'))
+        return 1
+    print(colored("Undo test Passed", 'green'))
+    return 0
+
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(unit_test())
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+import config
+from doc import Document
+from view import View
+from window import Window
+from cursor import Cursor
+from geom import Rect, Range
+from cell_buffer import CellBuffer
+from termcolor import colored
+
+
+class StubApp:
+    def __init__(self, width: int, height: int):
+        self.cells = CellBuffer(width, height)
+
+    def move(self, pos):
+        return self.cells.move(pos.x, pos.y)
+
+    def write(self, text, color):
+        self.cells.write(text, color)
+
+    def on_modify(self, doc, row):
+        pass
+
+    def on_edit(self, doc, edit):
+        pass
+
+
+def rendered_rows(view: View):
+    """
+    :return: Rows the view had to merge spans for to draw the whole window
+    """
+    rows = []
+    render_runs = view._render_runs
+
+    def counting(y, *args):
+        rows.append(y)
+        return render_runs(y, *args)
+
+    view._render_runs = counting
+    view.redraw_all()
+    del view._render_runs
+    return rows
+
+
+def unit_test():
+    config.app = StubApp(40, 12)
+    try:
+        doc = Document('', None)
+        view = View(Window(Rect(0, 0, 40, 12)), doc)
+        doc.insert_block(Cursor(0, 0), '\n'.join(f'def f{i}(x):  # row {i}' for i in range(30)))
+        doc._path = 'test.py'
+        doc.set_local_highlighting(True)
+        rendered_rows(view)
+        doc.insert_text(Cursor(0, 3), 'a')
+        if rendered_rows(view) != [3]:
+            print(colored("FAILED row cache (edit of one row)", 'red'))
+            return 1
+        doc.insert_text(Cursor(0, 5), '"""')
+        if len(rendered_rows(view)) != view.height() - 5:
+            print(colored("FAILED row cache (highlights below the edit)", 'red'))
+            return 1
+        if rendered_rows(view):
+            print(colored("FAILED row cache (unchanged rows)", 'red'))
+            return 1
+        text = doc.get_text()
+        for start, stop in [(Cursor(4, 2), Cursor(6, 20)), (Cursor(0, 7), Cursor(0, 9)), (Cursor(9, 1), Cursor(3, 1))]:
+            view._selection = Range(start, stop)
+            view.delete_selection()
+            doc.undo()
+            if doc.get_text() != text:
+                print(colored("FAILED delete selection", 'red'))
+                return 1
+        view._selection = Range(Cursor(4, 2), Cursor(6, 20))
+        view.delete_selection()
+        lines = text.split('\n')
+        if doc.get_text() != '\n'.join(lines[:2] + [lines[2][:4] + lines[20][6:]] + lines[21:]):
+            print(colored("FAILED delete selection", 'red'))
+            return 1
+    finally:
+        config.app = None
+    print(colored("View test Passed", 'green'))
+    return 0
+
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(unit_test())
@@ -1,5 +1,5 @@
 import logger
-from dataclasses import dataclass
+from array import array
 from geom import Point, Rect
 from io import StringIO
 
@@ -94,54 +94,33 @@ class TabExpander:
         return sio.getvalue()
 
 
-@dataclass
-class ColoringItem:
-    row: int
-    col: int
-    length: int
-    type_name: str
-
-
-def parse_coloring_data(data, tokens):
-    res = []
-    # logger.logwrite(str(data))
-    n = len(data)
-    i = 0
-    prev_row = 0
-    prev_col = 0
-    while i < n:
-        row = data[i] + prev_row
-        if row != prev_row:
-            prev_col = 0
-        col = data[i + 1] + prev_col
-        prev_row = row
-        prev_col = col
-        length = data[i + 2]
-        type_index = data[i + 3]
-        # mod_bits = data[i + 4]
-        i += 5
-        try:
-            type_name = tokens[type_index]
-        except IndexError:
-            type_name = "Unknown"
-        res.append(ColoringItem(row, col, length, type_name))
+def apply_semantic_token_edits(data: array, edits) -> array:
+    """
+    Apply the edits of a semanticTokens/full/delta response to the
+    token array of the previous result.  Edit offsets refer to the
+    previous array, so they are applied from the last one backwards.
+    """
+    res = array('I', data)
+    for edit in sorted(edits, key=lambda e: e['start'], reverse=True):
+        start = edit['start']
+        res[start:start + edit['deleteCount']] = array('I', edit.get('data', []))
     return res
 
 
-def parse_coloring_message(msg, tokens):
-    res = []
-    if 'result' not in msg:
-        return res, ''
+def parse_coloring_message(msg, previous: array = None):
+    """
+    :param previous: Token array of the previous result, to which delta edits apply
+    :return: Result id and token array of the whole document, empty if the result is null.
+    The array is None if the response holds edits and there is no previous array.
+    """
+    if 'result' not in msg or not msg['result']:
+        return '', array('I')
     result = msg['result']
-    result_id = result['resultId']
-    data = []
-    if 'data' in result:
-        res.extend(parse_coloring_data(result['data'], tokens))
+    result_id = result.get('resultId', '')
     if 'edits' in result:
-        edits = result['edits']
-        for edit in edits:
-            data = edit['data']
-            del_count = edit['deleteCount']
-            start = edit['start']
-            res.extend(parse_coloring_data(data, tokens))
-    return res, result_id
+        if previous is None:
+            return '', None
+        data = apply_semantic_token_edits(previous, result['edits'])
+    else:
+        data = array('I', result.get('data', []))
+    return result_id, data
@@ -3,7 +3,6 @@ import os
 import re
 from collections import OrderedDict
 from cursor import Cursor
-from visual_token import VisualToken
 from visual_line import VisualLine
 from dialogs.find_dialog import FindOptions
 import config
@@ -18,6 +17,10 @@ import clipboard
 word_pattern = re.compile(r'(\w+)')
 
 
+MAX_COLUMN = 1 << 30
+RUN_CACHE_SCREENS = 4
+
+
 # noinspection PyTypeChecker
 class View(FocusTarget):
     def __init__(self, window: Window, doc: Document = None):
@@ -27,23 +30,51 @@ class View(FocusTarget):
         if doc:
             doc.set_view(self)
             doc.add_modification_callback(self.modification_callback)
+            doc.add_edit_callback(self.edit_callback)
         self._visual_offset = Point(0, 0)
         self._selection: Range = None
         self._find_options: FindOptions = None
+        self._show_matches = False
+        self._matches_generation = 0
+        self._run_cache = OrderedDict()
+        self._spans = []
+        self._overlays = []
         self._cursor = Cursor()
         self._last_x = 0
         self._redraw = True
+        self._full_redraw = True
+        self._damaged_rows = set()
+        self._drawn_frame = None
+        self._drawn_text = None
+        self._drawn_selection = None
         self._insert = True
         self._current_tab = ''
         self._tabs: typing.OrderedDict[str, dict] = OrderedDict([('', self._generate_tab(Document('', self)))])
+        self._tabs.get('').get('_doc').add_modification_callback(self.modification_callback)
+        self._tabs.get('').get('_doc').add_edit_callback(self.edit_callback)
         self._menu = Menu('')
         self._pasting = False
         self.create_menu()
 
-    @staticmethod
-    def modification_callback(doc: Document, row: int):
+    def modification_callback(self, doc: Document, row: int):
+        if doc is self._doc:
+            self.damage(row)
         config.get_app().on_modify(doc, row)
 
+    @staticmethod
+    def edit_callback(doc: Document, edit):
+        config.get_app().on_edit(doc, edit)
+
+    def damage(self, row: int):
+        if row < 0:
+            self._full_redraw = True
+        else:
+            self._damaged_rows.add(row)
+
+    def invalidate(self):
+        self._full_redraw = True
+        self._drawn_frame = None
+
     def set_coloring_id(self, coloring_id: str):
         self._doc.set_coloring_id(coloring_id)
 
@@ -68,6 +99,7 @@ class View(FocusTarget):
         if path not in self._tabs:
             self._tabs[path] = self._generate_tab(doc)
         doc.add_modification_callback(self.modification_callback)
+        doc.add_edit_callback(self.edit_callback)
         self.switch_tab(path)
 
     def action_close_tab(self):
@@ -140,6 +172,14 @@ class View(FocusTarget):
     def height(self):
         return self._window.height()
 
+    def visible_rows(self, margin: int = 0):
+        """
+        :param margin: Rows to add above and below the window
+        :return: First visible row and the row after the last one
+        """
+        top = self._visual_offset.y
+        return max(0, top - margin), min(self._doc.rows_count(), top + self.height() + margin)
+
     def move_a_cursor(self, c: Cursor, dx: int, dy: int):
         if self._doc:
             c.move(dx, dy)
@@ -206,15 +246,7 @@ class View(FocusTarget):
         self.insert_text(text)
 
     def insert_text(self, full_text: str):
-        text_lines = full_text.split('\n')
-        first = True
-        for text in text_lines:
-            if not first:
-                self.action_enter()
-            self._doc.insert_text(self._cursor, text)
-            self._cursor.move(len(text), 0)
-            first = False
-        self.draw_cursor_line()
+        self.set_cursor(self._doc.insert_block(self._cursor, full_text))
         self.place_cursor()
 
     def action_backtab(self):
@@ -267,7 +299,6 @@ class View(FocusTarget):
         self.set_cursor(Cursor(0, self._cursor.y + 1))
         self._doc.insert_text(self.get_cursor(), white_prefix)
         self.set_cursor(Cursor(len(white_prefix), self._cursor.y))
-        self.redraw_all()
 
     def clear_selection(self):
         self._selection = None
@@ -280,48 +311,39 @@ class View(FocusTarget):
         if not self.delete_selection():
             self.set_cursor(self._doc.backspace(self._cursor))
 
-    def process_semantic_highlight(self, y: int, text: str, res: typing.List[VisualToken]):
-        semantic_highlights = self._doc.get_semantic_highlights()
-        if y in semantic_highlights:
-            line = self._doc.get_row(y)
-            x = 0
-            for col, length, token_type in semantic_highlights.get(y):
-                visual_column = line.get_visual_index(col)
-                if visual_column > x:
-                    res.append(VisualToken(x, text[x:visual_column]))
-                    x = visual_column
-                res.append(VisualToken(x, text[x:x + length]))
-                color = 16
-                if token_type in type_colors:
-                    color = type_colors.get(token_type)
-                res[-1].set_color(color)
-                x += length
-            if x < len(text):
-                res.append(VisualToken(x, text[x:]))
-        else:
-            res.append(VisualToken(0, text))
-
-    def add_highlights(self, y: int, line: VisualLine) -> typing.List[VisualToken]:
-        text = line.get_visual_text()
-        res = []
+    def _overlay_spans(self, y: int, line: VisualLine, spans: list):
+        """
+        Fill spans with the search matches and the selection on row y as
+        sorted, disjoint (start, end, color) triples of visual columns.
+        The selection wins over the matches it overlaps.
+        """
+        from_i = to_i = -1
         if self._selection:
             start, stop = self._selection.get_ordered()
-            sel_highlight = Color.TEXT_HIGHLIGHT
             if start.y <= y <= stop.y:
                 from_i = 0 if start.y < y else line.get_visual_index(start.x)
-                to_i = len(text) if stop.y > y else line.get_visual_index(stop.x)
-                if from_i > 0:
-                    res.append(VisualToken(0, text[0:from_i]))
-                res.append(VisualToken(from_i, text[from_i:to_i]))
-                res[-1].set_color(sel_highlight)
-                res.append(VisualToken(to_i, text[to_i:]))
-                if stop.y > y:
-                    res[-1].set_color(sel_highlight)
-            else:
-                self.process_semantic_highlight(y, text, res)
-        else:
-            self.process_semantic_highlight(y, text, res)
-        return res
+                to_i = MAX_COLUMN if stop.y > y else line.get_visual_index(stop.x)
+        selected = from_i >= to_i
+        options = self._find_options
+        if self._show_matches and options.action == 'Find' and options.find_text:
+            text = line.get_logical_text()
+            n = len(options.find_text)
+            x = self._find_in_row(text, options.find_text, 0)
+            while x >= 0:
+                if self._is_whole_match(text, x, n):
+                    start, end = line.get_visual_index(x), line.get_visual_index(x + n)
+                    if not selected and end > from_i:
+                        if start < from_i:
+                            spans.extend((start, from_i, Color.SEARCH))
+                        spans.extend((from_i, to_i, Color.TEXT_HIGHLIGHT))
+                        selected = True
+                    if selected and to_i > start:
+                        start = to_i
+                    if start < end:
+                        spans.extend((start, end, Color.SEARCH))
+                x = self._find_in_row(text, options.find_text, x + max(n, 1))
+        if not selected:
+            spans.extend((from_i, to_i, Color.TEXT_HIGHLIGHT))
 
     def draw_cursor_line(self):
         self.draw_line(self._cursor.y - self._visual_offset.y)
@@ -335,57 +357,105 @@ class View(FocusTarget):
         line = self._doc.get_row(line_index)
         return line.get_logical_text()
 
+    def _selection_key(self, y: int):
+        if self._selection is None:
+            return None
+        start, stop = self._selection.get_ordered()
+        if start.y <= y <= stop.y:
+            return start.x if start.y == y else -1, stop.x if stop.y == y else -1
+        return None
+
     def draw_line(self, y: int):
         line_index = y + self._visual_offset.y
+        self._window.set_cursor(0, y)
         if line_index >= self._doc.size():
-            self._window.set_cursor(0, y)
             self._window.text(' ' * self._window.width(), Color.TEXT)
             return
         line = self._doc.get_row(line_index)
-        tokens = self.add_highlights(line_index, line)
         x0 = self._visual_offset.x
         x1 = x0 + self._window.width()
-        for token in tokens:
-            token.clip(x0, x1)
-            token.move(-x0)
-        cx = 0
-        for token in tokens:
-            text = token.get_text()
-            if len(text) > 0:
-                self._window.set_cursor(token.get_pos(), y)
-                self._window.text(text, token.get_color())
-                cx = cx + len(text)
-        if cx < self.width():
-            self._window.set_cursor(cx, y)
-            color = 0
-            if len(tokens) > 0:
-                color = tokens[-1].get_color()
-            self._window.text(' ' * (self.width() - cx), color)
+        key = (line_index, line.get_version(), self._doc.highlights_version(line_index), self._selection_key(line_index),
+               self._matches_generation, x0, x1)
+        cache = self._run_cache
+        runs = cache.get(key)
+        if runs is None:
+            runs = self._render_runs(line_index, line, x0, x1)
+            cache[key] = runs
+            if len(cache) > RUN_CACHE_SCREENS * self.height():
+                cache.popitem(last=False)
+        else:
+            cache.move_to_end(key)
+        for text, color in runs:
+            self._window.text(text, color)
+
+    def _render_runs(self, y: int, line: VisualLine, x0: int, x1: int) -> list:
+        """
+        :return: List of (text, color) runs covering the visual columns x0 to x1 of row y
+        """
+        text = line.get_visual_text()
+        spans = self._spans
+        overlays = self._overlays
+        spans.clear()
+        overlays.clear()
+        # Semantic highlights as flat (start, end, color) triples of visual columns
+        self._doc.get_semantic_highlights().extend_spans(y, line, spans, type_colors, 16)
+        self._overlay_spans(y, line, overlays)
+        n, m = len(spans), len(overlays)
+        i = j = 0
+        x = x0
+        runs = []
+        while x < x1:
+            while i < n and spans[i + 1] <= x:
+                i += 3
+            while j < m and overlays[j + 1] <= x:
+                j += 3
+            if j < m and overlays[j] <= x:
+                color, end = overlays[j + 2], overlays[j + 1]
+            else:
+                if i < n and spans[i] <= x:
+                    color, end = spans[i + 2], spans[i + 1]
+                else:
+                    color, end = Color.TEXT, spans[i] if i < n else MAX_COLUMN
+                if j < m:
+                    end = min(end, overlays[j])
+            end = min(end, x1)
+            run = text[x:end]
+            if len(run) < end - x:
+                run += ' ' * (end - x - len(run))
+            runs.append((run, color))
+            x = end
+        return runs
 
     def redraw_all(self):
         # self.window.clear()
         for y in range(self.height()):
             self.draw_line(y)
         self._window.set_cursor(self.doc2win(self._cursor))
+        self._full_redraw = False
+        self._damaged_rows.clear()
+        self._drawn_selection = self._selection_state()
 
-    def _render_tabs(self):
+    def _tab_titles(self):
+        titles = []
+        start_index = 0
+        for path in self._tabs:
+            tab = self._tabs.get(path)
+            tab_doc = tab.get('_doc')
+            mod = ' *' if tab_doc.is_modified() else ''
+            tab_title = tab_doc.get_filename()
+            color = Color.BORDER
+            if path == self._current_tab:
+                color = Color.BORDER_HIGHLIGHT
+                start_index = len(titles)
+                if path:
+                    tab_title = os.path.relpath(path, config.work_dir)
+            titles.append((tab_title + mod, color))
+        if start_index > 0:
+            titles = titles[start_index:] + titles[0:start_index]
+        return titles
+
+    def _render_tabs(self, titles):
         if self._window.is_border():
-            titles = []
-            start_index = 0
-            for path in self._tabs:
-                tab = self._tabs.get(path)
-                tab_doc = tab.get('_doc')
-                mod = ' *' if tab_doc.is_modified() else ''
-                tab_title = tab_doc.get_filename()
-                color = Color.BORDER
-                if path == self._current_tab:
-                    color = Color.BORDER_HIGHLIGHT
-                    start_index = len(titles)
-                    if path:
-                        tab_title = os.path.relpath(path, config.work_dir)
-                titles.append((tab_title + mod, color))
-            if start_index > 0:
-                titles = titles[start_index:] + titles[0:start_index]
             x = 2
             i = 0
             while i < len(titles):
@@ -394,13 +464,65 @@ class View(FocusTarget):
                     x += 3 + len(titles[i][0])
                 i += 1
 
+    def _selection_state(self):
+        if self._selection is None:
+            return None
+        start, stop = self._selection.get_ordered()
+        return start.x, start.y, stop.x, stop.y
+
+    def _damage_selection(self, top: int, bottom: int):
+        """
+        Damage the visible rows covered by the selection drawn last time
+        and by the current one
+        """
+        selection = self._selection_state()
+        if selection != self._drawn_selection:
+            for s in (selection, self._drawn_selection):
+                if s is not None:
+                    self._damaged_rows.update(range(max(top, s[1]), min(bottom, s[3] + 1)))
+            self._drawn_selection = selection
+
     def render(self):
         if self._window.is_hidden():
             return
         self._window.set_footnote(0, f'{self._cursor.x + 1},{self._cursor.y + 1}')
-        self._window.render()
-        self._render_tabs()
-        self.redraw_all()
+        titles = self._tab_titles()
+        frame = (self._window.render_key(), tuple(titles))
+        if frame != self._drawn_frame:
+            self._drawn_frame = frame
+            self._window.render()
+            self._render_tabs(titles)
+        text = (self._doc, self._visual_offset.x, self._visual_offset.y, self._window.render_key()[0:4])
+        if text != self._drawn_text:
+            if not self._full_redraw and not self._scroll_from(self._drawn_text, text):
+                self._full_redraw = True
+            self._drawn_text = text
+        if self._full_redraw:
+            self.redraw_all()
+        else:
+            top = self._visual_offset.y
+            self._damage_selection(top, top + self.height())
+            for row in sorted(self._damaged_rows):
+                if 0 <= row - top < self.height():
+                    self.draw_line(row - top)
+            self._damaged_rows.clear()
+            self._window.set_cursor(self.doc2win(self._cursor))
+
+    def _scroll_from(self, drawn, text) -> bool:
+        """
+        Scroll the rows still visible since the last render in the
+        terminal and damage only the rows scrolled in
+        :return: False if the whole view has to be redrawn
+        """
+        if drawn is None or drawn[0:2] != text[0:2] or drawn[3] != text[3]:
+            return False
+        dy = text[2] - drawn[2]
+        height = self.height()
+        if abs(dy) >= height or not self._window.scroll(dy):
+            return False
+        top = text[2]
+        self._damaged_rows.update(range(top + height - dy, top + height) if dy > 0 else range(top, top - dy))
+        return True
 
     def scroll_display(self):
         x, y = self.doc2win(self._cursor)
@@ -432,19 +554,7 @@ class View(FocusTarget):
             return False
         self._doc.start_compound()
         start, stop = self._selection.get_ordered()
-        if start.y == stop.y:
-            self._doc.delete_block(start.y, start.x, stop.x)
-        else:
-            dstart = 0
-            if start.x > 0:
-                self._doc.delete_block(start.y, start.x, self._doc.get_row(start.y).get_logical_len())
-                dstart = 1
-            if stop.x > 0:
-                self._doc.delete_block(stop.y, 0, stop.x)
-            for y in range(start.y + dstart, stop.y):
-                self._doc.delete_line(start.y + dstart)
-            if start.x > 0:
-                self._doc.join_next_row(start.y)
+        self._doc.delete_range(start.y, start.x, stop.y, stop.x)
         self.set_cursor(start)
         self._doc.stop_compound()
         self._selection = None
@@ -468,6 +578,22 @@ class View(FocusTarget):
             self._doc.replace_text(self._cursor, key)
         self.action_move_right()
 
+    def is_plain_text_key(self, key: str) -> bool:
+        """
+        :return: Whether typing key does nothing but insert it at the cursor
+        """
+        return self._insert and len(key) == 1 and 32 <= ord(key) < 127 and key != '}'
+
+    def type_text(self, text: str):
+        """
+        Insert keys typed ahead, all plain text keys, as one edit
+        """
+        self._doc.start_compound()
+        self.delete_selection()
+        self.insert_text(text)
+        self._doc.stop_compound()
+        self._last_x = self._cursor.x
+
     def process_key(self, key: str):
         if len(key) == 1:
             code = ord(key)
@@ -504,8 +630,17 @@ class View(FocusTarget):
 
     def find_replace(self, options: FindOptions):
         self._find_options = options
+        self._show_matches = True
+        self._matches_generation += 1
+        self.invalidate()
         self.action_find_replace_next()
 
+    def action_escape(self):
+        if self._show_matches:
+            self._show_matches = False
+            self._matches_generation += 1
+            self.invalidate()
+
     def _find_regex_in_row(self, row_text: str, from_x: int):
         m = self._find_options.regex_pattern.search(row_text, from_x)
         if m:
@@ -523,6 +658,14 @@ class View(FocusTarget):
         except ValueError:
             return -1
 
+    def _is_whole_match(self, text: str, x: int, n: int):
+        if self._find_options.whole:
+            if x > 0 and text[x - 1].isalnum():
+                return False
+            if (x + n) < len(text) and text[x + n].isalnum():
+                return False
+        return True
+
     def _find_next(self):
         y = self._cursor.y
         x = self._cursor.x
@@ -534,13 +677,7 @@ class View(FocusTarget):
                 x = self._find_in_row(text, find_text, x + 1)
                 if x < 0:
                     break
-                found = True
-                if self._find_options.whole:
-                    if x > 0 and text[x - 1].isalnum():
-                        found = False
-                    if (x + len(find_text)) < len(text) and text[x + len(find_text)].isalnum():
-                        found = False
-                if found:
+                if self._is_whole_match(text, x, len(find_text)):
                     self.set_cursor(Cursor(x, y))
                     return True
             y = y + 1
@@ -698,17 +835,23 @@ class View(FocusTarget):
             clipboard.copy(text)
             self.delete_selection()
 
-    def action_paste(self):
+    def paste_text(self, text: str):
         self._pasting = True
         self._doc.start_compound()
         self.delete_selection()
-        text = clipboard.paste()
         self.insert_text(text)
         self._doc.stop_compound()
+        self._pasting = False
+
+    def action_paste(self):
+        self.paste_text(clipboard.paste())
 
     def action_undo(self):
         self._doc.undo()
 
+    def action_redo(self):
+        self._doc.redo()
+
     def action_next_tab(self):
         self.next_tab(1)
 
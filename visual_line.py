@@ -1,8 +1,14 @@
+from array import array
+from bisect import bisect_left, bisect_right
+from itertools import count
 from config import const
-from textwrap import TextWrapper
 
-wrapper = TextWrapper(width=1000000000, expand_tabs=True, tabsize=const.TABSIZE, replace_whitespace=True,
-                      drop_whitespace=False)
+# Versions are unique across all lines, so a version identifies both a
+# line and its content
+_versions = count()
+
+# Other whitespace is shown as a single space, as TextWrapper's replace_whitespace did
+_whitespace = str.maketrans('\n\v\f\r', '    ')
 
 
 def tab_spaces(pos):
@@ -13,24 +19,100 @@ class VisualLine:
     def __init__(self, text: str = ''):
         self._visual_text = ''
         self._logical_text = ''
-        self._tabs = []
+        # Logical position and visual start column of every tab.
+        # A tab always ends on a TABSIZE boundary, so these two arrays
+        # are enough to map columns in both directions with a bisect.
+        self._tabs = array('l')
+        self._tab_columns = array('l')
+        self._version = next(_versions)
         if text:
             self.set_text(text)
 
+    def get_version(self) -> int:
+        return self._version
+
     def set_text(self, text: str):
-        self._tabs = [i for i, c in enumerate(text) if c == '\t']
+        self._version = next(_versions)
+        tabs, columns, visual, _ = self._expand(text, 0, 0)
         self._logical_text = text
-        self._visual_text = wrapper.fill(text)
-        extra = 0
-        for i in range(len(self._tabs)):
-            self._tabs[i] += extra
-            spaces = tab_spaces(self._tabs[i])
-            extra += spaces - 1
+        self._visual_text = visual
+        self._tabs = array('l', tabs)
+        self._tab_columns = array('l', columns)
+
+    def _shift_tabs(self, k: int, dx: int, dcol: int):
+        tabs = self._tabs
+        columns = self._tab_columns
+        for i in range(k, len(tabs)):
+            tabs[i] += dx
+            columns[i] += dcol
+
+    @staticmethod
+    def _expand(text: str, pos: int, col: int):
+        """
+        Expand text that starts at logical position pos and visual column col
+        :return: tab positions, tab columns, visual text and the end column
+        """
+        text = text.translate(_whitespace)
+        if '\t' not in text:
+            return [], [], text, col + len(text)
+        tabs = []
+        columns = []
+        visual = []
+        parts = text.split('\t')
+        for part in parts[:-1]:
+            pos += len(part)
+            col += len(part)
+            spaces = tab_spaces(col)
+            tabs.append(pos)
+            columns.append(col)
+            visual.append(part)
+            visual.append(' ' * spaces)
+            pos += 1
+            col += spaces
+        visual.append(parts[-1])
+        col += len(parts[-1])
+        return tabs, columns, ''.join(visual), col
+
+    def _replace(self, pos: int, right: int, text: str):
+        """
+        Replace the logical range [pos,right) with text.
+        Only the inserted text and the run up to the first tab after it are
+        expanded again.  That tab absorbs the width change unless it crosses
+        a tab stop, in which case every later tab moves a whole stop.
+        """
+        self._version = next(_versions)
+        visual = self._visual_text
+        tabs = self._tabs
+        columns = self._tab_columns
+        v = self.get_visual_index(pos)
+        v_right = self.get_visual_index(right)
+        k = bisect_left(tabs, pos)
+        m = bisect_left(tabs, right)
+        new_tabs, new_columns, segment, col = self._expand(text, pos, v)
+        self._logical_text = self._logical_text[0:pos] + text + self._logical_text[right:]
+        if m == len(tabs):
+            self._visual_text = visual[0:v] + segment + visual[v_right:]
+            if k < len(tabs) or new_tabs:
+                tabs[k:] = array('l', new_tabs)
+                columns[k:] = array('l', new_columns)
+            return
+        dx = len(text) - (right - pos)
+        tab_col = columns[m]
+        tab_end = tab_col + tab_spaces(tab_col)
+        plain = visual[v_right:tab_col]
+        new_col = col + len(plain)
+        new_end = new_col + tab_spaces(new_col)
+        self._visual_text = visual[0:v] + segment + plain + ' ' * (new_end - new_col) + visual[tab_end:]
+        new_tabs.append(tabs[m] + dx)
+        new_columns.append(new_col)
+        tabs[k:m + 1] = array('l', new_tabs)
+        columns[k:m + 1] = array('l', new_columns)
+        self._shift_tabs(k + len(new_tabs), dx, new_end - tab_end)
 
     def insert(self, pos: int, text: str):
         if pos < 0 or pos > self.get_logical_len():
             return False
-        self.set_text(self._logical_text[0:pos] + text + self._logical_text[pos:])
+        self._replace(pos, pos, text)
         return True
 
     def append(self, text: str):
@@ -50,7 +132,7 @@ class VisualLine:
         right = pos + n
         if right > len(self._logical_text):
             right = len(self._logical_text)
-        self.set_text(self._logical_text[0:pos] + self._logical_text[right:])
+        self._replace(pos, right, '')
         return True
 
     def get_logical_len(self):
@@ -66,28 +148,25 @@ class VisualLine:
         return self._visual_text
 
     def get_visual_index(self, pos: int):
-        if pos < 0:
-            return -1
-        for tab in self._tabs:
-            if pos <= tab:
-                break
-            pos += tab_spaces(tab) - 1
-        if pos > len(self._visual_text):
+        if pos < 0 or pos > len(self._logical_text):
             return -1
-        return pos
+        k = bisect_left(self._tabs, pos)
+        if k == 0:
+            return pos
+        col = self._tab_columns[k - 1]
+        return col + tab_spaces(col) + pos - self._tabs[k - 1] - 1
 
     def get_logical_index(self, pos: int):
         if pos > len(self._visual_text) or pos < 0:
             return -1
-        for tab in reversed(self._tabs):
-            if pos > tab:
-                spaces = tab_spaces(tab)
-                nxt = tab + spaces
-                if pos >= nxt:
-                    pos -= spaces - 1
-                else:
-                    pos = tab
-        return pos
+        k = bisect_right(self._tab_columns, pos)
+        if k == 0:
+            return pos
+        col = self._tab_columns[k - 1]
+        end = col + tab_spaces(col)
+        if pos < end:
+            return self._tabs[k - 1]
+        return self._tabs[k - 1] + 1 + pos - end
 
     def split(self, pos: int):
         if pos < 0 or pos > self.get_logical_len():
@@ -101,9 +180,9 @@ class VisualLine:
 
     def extend(self, line):
         if isinstance(line, VisualLine):
-            self.set_text(self._logical_text + line.get_logical_text())
+            self.append(line.get_logical_text())
         elif isinstance(line, str):
-            self.set_text(self._logical_text + line)
+            self.append(line)
         else:
             raise RuntimeError('Invalid type in VisualLine.extend')
 
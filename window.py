@@ -61,6 +61,11 @@ class Window:
     def set_title(self, title: str):
         self._title = title
 
+    def render_key(self):
+        r = self.rect
+        footnotes = tuple(sorted(self._footnotes.items()))
+        return r.pos.x, r.pos.y, r.size.x, r.size.y, self._border, self._border_type, self._title, footnotes
+
     def contains(self, p):
         if not isinstance(p, Point):
             p = Point(p)
@@ -83,6 +88,15 @@ class Window:
         h = self.rect.height()
         return h - 2 if self._border else h
 
+    def scroll(self, dy: int) -> bool:
+        """
+        Scroll the inside of the window up by dy rows, or down if dy is negative
+        """
+        # The side borders are the same on every row inside, so they scroll
+        # along, and a window as wide as the screen scrolls in the terminal
+        return get_app().scroll_rect(Rect(self.rect.pos.x, self.rect.pos.y + int(self._border),
+                                          self.rect.width(), self.height()), dy)
+
     def requested_size(self) -> Point:
         return self.size_preference
 